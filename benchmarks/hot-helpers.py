@@ -0,0 +1,208 @@
+#!/usr/bin/python
+
+# Benchmarks of the hot helpers, run offline against a synthetic GRUB source tree and a disk image file.
+# Results are printed (or written to the file specified by -o) as JSON, so that they can be compared between versions.
+#
+# usage: hot-helpers.py [-o OUTPUT_FILE] [-n REPEAT] [-k NAME_SUBSTRING]
+
+import os
+import sys
+import json
+import time
+import struct
+import timeit
+import argparse
+import platform
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python3"))       # run from a checkout
+import grub_install
+from grub_install._util import is_buffer_all_zero, find_first_non_zero_byte, compare_files, compare_directories, SectorSnapshot, PartiUtil
+from grub_install._cache import DigestCache, set_default_digest_cache
+from grub_install._handy import Grub
+
+
+MBR_GAP_SIZE = 512 * 1024                           # MBR + MBR-gap, same as _Bios._getCoreBufMaxSize()
+CORE_IMG_SIZE = 32 * 1024                           # typical core.img
+MODULE_COUNT = 280                                  # typical number of modules of a platform
+MODULE_SIZE = 8 * 1024
+LOCALE_COUNT = 50
+THEME_FILE_COUNT = 100
+
+
+def make_synthetic_source(baseDir):
+    platDir = os.path.join(baseDir, "usr", "lib", "grub", "i386-pc")
+    os.makedirs(platDir)
+    modList = ["mod%03d" % (i) for i in range(MODULE_COUNT)]
+    for m in modList:
+        with open(os.path.join(platDir, m + ".mod"), "wb") as f:
+            f.write(os.urandom(MODULE_SIZE))
+    with open(os.path.join(platDir, "moddep.lst"), "w") as f:
+        for i, m in enumerate(modList):
+            f.write("%s: %s\n" % (m, " ".join(modList[max(0, i - 3):i])))
+    for fn in ["command.lst", "fs.lst", "partmap.lst", "video.lst", "crypto.lst", "parttool.lst", "terminal.lst", "modinfo.sh"]:
+        with open(os.path.join(platDir, fn), "w") as f:
+            f.write("")
+    with open(os.path.join(platDir, "boot.img"), "wb") as f:
+        f.write(bytes(Grub.DISK_SECTOR_SIZE))
+
+    shareDir = os.path.join(baseDir, "usr", "share", "grub")
+    os.makedirs(os.path.join(shareDir, "themes", "starfield"))
+    with open(os.path.join(shareDir, "unicode.pf2"), "wb") as f:
+        f.write(os.urandom(2 * 1024 * 1024))
+    for i in range(THEME_FILE_COUNT):
+        with open(os.path.join(shareDir, "themes", "starfield", "file%03d.png" % (i)), "wb") as f:
+            f.write(os.urandom(16 * 1024))
+
+    for i in range(LOCALE_COUNT):
+        dirpath = os.path.join(baseDir, "usr", "share", "locale", "l%02d" % (i), "LC_MESSAGES")
+        os.makedirs(dirpath)
+        with open(os.path.join(dirpath, "grub.mo"), "wb") as f:
+            f.write(os.urandom(64 * 1024))
+
+
+def make_synthetic_core_img():
+    buf = bytearray(os.urandom(CORE_IMG_SIZE))
+    struct.pack_into("<H", buf, Grub.DISK_SECTOR_SIZE + Grub.KERNEL_I386_PC_NO_REED_SOLOMON_LENGTH, 0x400)
+    return bytes(buf)
+
+
+def naive_is_buffer_all_zero(buf):
+    for b in buf:
+        if b != 0:
+            return False
+    return True
+
+
+def bench(name, func, repeat, number=1, setup=None, **attrs):
+    ret = {"name": name}
+    ret.update(attrs)
+    try:
+        if setup is not None:
+            setup()
+        func()                                                          # warm up, and check it works
+        timeList = []
+        for i in range(repeat):
+            if setup is not None:
+                setup()
+            timeList.append(timeit.timeit(func, number=number) / number)
+        ret["repeat"] = repeat
+        ret["number"] = number
+        ret["min"] = min(timeList)
+        ret["mean"] = sum(timeList) / len(timeList)
+    except Exception as e:
+        ret["error"] = "%s: %s" % (e.__class__.__name__, e)
+    return ret
+
+
+def run_all(workDir, repeat):
+    ret = []
+
+    # is_buffer_all_zero, find_first_non_zero_byte, compared with a byte by byte loop
+    for name, buf in [
+        ("all-zero", bytes(MBR_GAP_SIZE - Grub.DISK_SECTOR_SIZE)),
+        ("gap-after-core-img", bytes(MBR_GAP_SIZE - Grub.DISK_SECTOR_SIZE - CORE_IMG_SIZE)),
+        ("non-zero-at-end", bytes(MBR_GAP_SIZE - Grub.DISK_SECTOR_SIZE - 1) + b'\x01'),
+    ]:
+        assert is_buffer_all_zero(buf) == naive_is_buffer_all_zero(buf)
+        ret.append(bench("naive_is_buffer_all_zero/" + name, lambda: naive_is_buffer_all_zero(buf), repeat, 5, size=len(buf)))
+        ret.append(bench("is_buffer_all_zero/" + name, lambda: is_buffer_all_zero(buf), repeat, 20, size=len(buf)))
+        ret.append(bench("find_first_non_zero_byte/" + name, lambda: find_first_non_zero_byte(buf), repeat, 20, size=len(buf)))
+
+    # _Bios._getRsEncodedCoreBuf, cold means the encode cache is empty
+    try:
+        from grub_install._target import _Bios
+        from grub_install import _reedsolomon
+        coreBuf = make_synthetic_core_img()
+
+        def __rsEncode():
+            _Bios._getRsEncodedCoreBuf(coreBuf, False)
+        ret.append(bench("_getRsEncodedCoreBuf/cold", __rsEncode, repeat, setup=_reedsolomon._rsEncodeCache.clear, size=len(coreBuf), rs_engine=grub_install.get_rs_engine().name))
+        ret.append(bench("_getRsEncodedCoreBuf/warm", __rsEncode, repeat, 20, size=len(coreBuf), rs_engine=grub_install.get_rs_engine().name))
+    except ImportError as e:
+        ret.append({"name": "_getRsEncodedCoreBuf", "error": "%s: %s" % (e.__class__.__name__, e)})
+
+    # Source enumeration
+    srcDir = os.path.join(workDir, "source")
+    make_synthetic_source(srcDir)
+    indexDir = os.path.join(workDir, "index")
+    ret.append(bench("Source/scan", lambda: grub_install.Source(srcDir), repeat))
+    ret.append(bench("Source/cached-index", lambda: grub_install.Source(srcDir, index_cache_dir=indexDir), repeat))
+    src = grub_install.Source(srcDir)
+
+    def __enumerate():
+        src.get_all_platform_directories()
+        src.get_platform_files(grub_install.PlatformType.I386_PC)
+        src.get_all_locale_files()
+        src.get_all_font_files()
+        src.get_all_theme_directories()
+    ret.append(bench("Source/enumerate", __enumerate, repeat, 20))
+    ret.append(bench("Source/module-closure", lambda: src.get_module_dependency_closure(grub_install.PlatformType.I386_PC, ["mod%03d" % (MODULE_COUNT - 1)]), repeat, 20))
+
+    # compare_files, compare_directories, cold means the digest cache is empty
+    dstDir = os.path.join(workDir, "copy")
+    os.mkdir(dstDir)
+    src.copy_into(dstDir)
+    fontFile = src.get_font_file("unicode")
+    fontFile2 = os.path.join(dstDir, os.path.relpath(fontFile, srcDir))
+    themeDir = src.get_theme_directory("starfield")
+    themeDir2 = os.path.join(dstDir, os.path.relpath(themeDir, srcDir))
+
+    def __clearDigestCache():
+        set_default_digest_cache(DigestCache())
+    ret.append(bench("compare_files/cold", lambda: compare_files(fontFile, fontFile2), repeat, setup=__clearDigestCache, size=os.path.getsize(fontFile)))
+    ret.append(bench("compare_files/warm", lambda: compare_files(fontFile, fontFile2), repeat, 20, size=os.path.getsize(fontFile)))
+    ret.append(bench("compare_directories/cold", lambda: compare_directories(themeDir, themeDir2), repeat, setup=__clearDigestCache, files=THEME_FILE_COUNT))
+    ret.append(bench("compare_directories/warm", lambda: compare_directories(themeDir, themeDir2), repeat, 20, files=THEME_FILE_COUNT))
+
+    # PartiUtil regex helpers
+    devList = ["/dev/sda", "/dev/sda1", "/dev/vdb3", "/dev/xvdc", "/dev/nvme0n1", "/dev/nvme0n1p2"]
+    partiList = [x for x in devList if not PartiUtil.isDiskOrParti(x)]
+
+    def __partiUtil():
+        for x in devList:
+            PartiUtil.isDiskOrParti(x)
+        for x in partiList:
+            PartiUtil.diskToParti(PartiUtil.partiToDisk(x), 1)
+    ret.append(bench("PartiUtil", __partiUtil, repeat, 1000, devices=len(devList)))
+
+    # MBR-gap read and write against a disk image file, same operations as _Bios.install_with_mbr()
+    imgFile = os.path.join(workDir, "disk.img")
+    with open(imgFile, "wb") as f:
+        f.truncate(4 * MBR_GAP_SIZE)
+    bufList = [bytes(MBR_GAP_SIZE), bytes(Grub.DISK_SECTOR_SIZE) + make_synthetic_core_img() + bytes(MBR_GAP_SIZE - Grub.DISK_SECTOR_SIZE - CORE_IMG_SIZE)]
+
+    def __readWrite():
+        for buf in bufList:
+            SectorSnapshot(imgFile, 0, MBR_GAP_SIZE).write_if_different(buf, Grub.DISK_SECTOR_SIZE)
+    ret.append(bench("mbr-gap/read", lambda: SectorSnapshot(imgFile, 0, MBR_GAP_SIZE), repeat, 20, size=MBR_GAP_SIZE))
+    ret.append(bench("mbr-gap/read-write", __readWrite, repeat, 5, size=MBR_GAP_SIZE))
+    ret.append(bench("mbr-gap/read-unchanged", lambda: SectorSnapshot(imgFile, 0, MBR_GAP_SIZE).write_if_different(bufList[-1], Grub.DISK_SECTOR_SIZE), repeat, 20, size=MBR_GAP_SIZE))
+
+    return ret
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", dest="output", help="write results to this file instead of stdout")
+    parser.add_argument("-n", dest="repeat", type=int, default=5, help="number of measurements of each benchmark")
+    parser.add_argument("-k", dest="keyword", help="only keep results whose name contains this string")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workDir:
+        resultList = run_all(workDir, args.repeat)
+    if args.keyword is not None:
+        resultList = [x for x in resultList if args.keyword in x["name"]]
+
+    data = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "grub_install": grub_install.__version__,
+        "results": resultList,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(data, f, indent=4)
+    else:
+        json.dump(data, sys.stdout, indent=4)
+        print("")
@@ -44,6 +44,24 @@ from ._source import Source
 
 from ._target import Target
 
+from ._fleet import FleetJob
+from ._fleet import FleetJobResult
+from ._fleet import FleetInstaller
+
+from ._async import AsyncTarget
+
+from ._cache import CoreImageCache
+from ._cache import DigestCache
+from ._cache import get_default_digest_cache
+from ._cache import set_default_digest_cache
+
+from ._reedsolomon import RsEngine
+from ._reedsolomon import get_rs_engine
+from ._reedsolomon import set_rs_engine
+
+from ._trace import Tracer
+from ._trace import Span
+
 from ._errors import SourceError
 from ._errors import TargetError
 from ._errors import InstallError
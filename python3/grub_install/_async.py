@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import asyncio
+import functools
+from ._const import TargetType
+from ._handy import Grub, GrubMountPoint
+from ._target import Target
+
+
+class AsyncTarget:
+
+    """asyncio wrapper of Target, grub-probe and grub-mkimage are run as asyncio subprocesses, other work is done in executor"""
+
+    def __init__(self, target, executor=None):
+        # platform install info of target should have been filled, or self.platforms blocks on disk I/O, create() does it
+        assert isinstance(target, Target)
+        self._target = target
+        self._executor = executor
+
+    @classmethod
+    async def create(cls, target_type, target_access_mode, executor=None, **kwargs):
+        # arguments are the same as Target()
+        if target_type == TargetType.MOUNTED_HDD_DEV:
+            mp = kwargs.get("boot_mount_point", None)
+            if mp is None:
+                mp = kwargs["rootfs_mount_point"]
+            await GrubMountPoint.prefetch_probe(mp.device, mp.mountpoint, executor)
+        target = await cls._run(executor, Target, target_type, target_access_mode, **kwargs)
+        await cls._run(executor, lambda: target.platforms)                  # fill platform install info, it reads MBR and partition table
+        return cls(target, executor)
+
+    @property
+    def target(self):
+        return self._target
+
+    @property
+    def target_type(self):
+        return self._target.target_type
+
+    @property
+    def target_access_mode(self):
+        return self._target.target_access_mode
+
+    @property
+    def platforms(self):
+        return self._target.platforms
+
+    def get_platform_install_info(self, platform_type):
+        return self._target.get_platform_install_info(platform_type)
+
+    async def install_platform(self, platform_type, source, **kwargs):
+        await self._prefetchCoreImages([platform_type], source, kwargs.get("debug_image", None))
+        await self._run(self._executor, self._target.install_platform, platform_type, source, **kwargs)
+
+    async def install_platforms(self, platform_types, source, **kwargs):
+        if isinstance(platform_types, dict):
+            await asyncio.gather(*[self._prefetchCoreImages([pt], source, platform_types[pt].get("debug_image", kwargs.get("debug_image", None))) for pt in platform_types])
+        else:
+            await self._prefetchCoreImages(platform_types, source, kwargs.get("debug_image", None))
+        await self._run(self._executor, self._target.install_platforms, platform_types, source, **kwargs)
+
+    async def remove_platform(self, platform_type, **kwargs):
+        await self._run(self._executor, self._target.remove_platform, platform_type, **kwargs)
+
+    async def install_data_files(self, source, locales=None, fonts=None, themes=None):
+        await self._run(self._executor, self._target.install_data_files, source, locales, fonts, themes)
+
+    async def remove_data_files(self):
+        await self._run(self._executor, self._target.remove_data_files)
+
+    async def remove_all(self):
+        await self._run(self._executor, self._target.remove_all)
+
+    async def compare_with_source(self, source, max_workers=None):
+        # core images are usually made without debug_image, other candidates are made in executor when needed
+        platformTypeList = await self._run(self._executor, lambda: self._target.platforms)
+        await self._prefetchCoreImages(platformTypeList, source, None)
+        await self._run(self._executor, self._target.compare_with_source, source, max_workers)
+
+    async def _prefetchCoreImages(self, platformTypeList, source, debugImage):
+        # put core images into the core image cache, so that the target operation doesn't block on grub-mkimage
+        p = self._target
+        if p.core_image_cache is None:
+            return
+        argsList = await self._run(self._executor, lambda: [p.get_core_image_args(pt) for pt in platformTypeList])
+        await asyncio.gather(*[Grub.makeCoreImageAsync(source, pt, *args, debugImage, tmpDir=p.tmp_work_dir, cache=p.core_image_cache, executor=self._executor)
+                               for pt, args in zip(platformTypeList, argsList) if args is not None])
+
+    @staticmethod
+    async def _run(executor, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args, **kwargs))
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import json
+import mmap
+import atexit
+import shutil
+import pathlib
+import hashlib
+import tempfile
+import threading
+import collections
+
+
+class CoreImageCache:
+
+    """Two level (memory and disk) LRU cache for the output of grub-mkimage"""
+
+    DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        self._cacheDir = cache_dir
+        self._maxSize = max_size
+        self._lock = threading.Lock()
+        self._memDict = collections.OrderedDict()
+        self._memSize = 0
+
+        if self._cacheDir is not None:
+            os.makedirs(self._cacheDir, exist_ok=True)
+
+    @property
+    def cache_dir(self):
+        return self._cacheDir
+
+    @property
+    def max_size(self):
+        return self._maxSize
+
+    def get(self, key):
+        with self._lock:
+            buf = self._memDict.get(key)
+            if buf is not None:
+                self._memDict.move_to_end(key)
+                return buf
+
+        if self._cacheDir is None:
+            return None
+
+        fullfn = self._getCacheFile(key)
+        try:
+            buf = pathlib.Path(fullfn).read_bytes()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(fullfn)                                    # mtime is used as the access time for LRU eviction
+        except OSError:
+            pass                                                # cache directory may be read-only, shared by other users
+
+        with self._lock:
+            self._memPut(key, buf)
+        return buf
+
+    def put(self, key, buf):
+        buf = bytes(buf)
+
+        with self._lock:
+            self._memPut(key, buf)
+
+        if self._cacheDir is not None:
+            try:
+                fd, tmpFullfn = tempfile.mkstemp(dir=self._cacheDir, prefix=".tmp-")
+            except OSError:
+                return                                          # read-only cache directory, only the memory cache is used
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(buf)
+                os.replace(tmpFullfn, self._getCacheFile(key))
+            except BaseException:
+                os.unlink(tmpFullfn)
+                raise
+            self._diskEvict()
+
+    def clear(self):
+        with self._lock:
+            self._memDict.clear()
+            self._memSize = 0
+
+        if self._cacheDir is not None:
+            for de in os.scandir(self._cacheDir):
+                if de.name.endswith(".img"):
+                    os.unlink(de.path)
+
+    @staticmethod
+    def make_key(mkimage_target, module_list, fs_uuid, hints, prefix, debug_image, platform_dir, platform_files):
+        h = hashlib.sha256()
+
+        def __update(*args):
+            for arg in args:
+                h.update(repr(arg).encode("utf-8"))
+                h.update(b"\x00")
+
+        # content of grub-mkimage itself and all the files it may read are part of the key, digests are cached by DigestCache
+        digestCache = get_default_digest_cache()
+        mkimage = shutil.which("grub-mkimage")
+        if mkimage is not None:
+            __update(mkimage, digestCache.get_digest(mkimage))
+        else:
+            __update(None)
+
+        __update(mkimage_target, list(module_list), fs_uuid, hints, prefix, debug_image)
+
+        # platform_files is {filename: ...} from Source
+        __update(platform_dir)
+        for fn in sorted(platform_files):
+            __update(fn, digestCache.get_digest(os.path.join(platform_dir, fn)))
+
+        return h.hexdigest()
+
+    def _getCacheFile(self, key):
+        return os.path.join(self._cacheDir, key + ".img")
+
+    def _memPut(self, key, buf):
+        if key in self._memDict:
+            self._memSize -= len(self._memDict.pop(key))
+        if len(buf) > self._maxSize:
+            return
+        self._memDict[key] = buf
+        self._memSize += len(buf)
+        while self._memSize > self._maxSize:
+            self._memSize -= len(self._memDict.popitem(last=False)[1])
+
+    def _diskEvict(self):
+        fileList = []
+        totalSize = 0
+        for de in os.scandir(self._cacheDir):
+            if de.name.endswith(".img"):
+                try:
+                    st = de.stat()
+                except FileNotFoundError:
+                    continue                                    # removed by another process
+                fileList.append((st.st_mtime_ns, st.st_size, de.path))
+                totalSize += st.st_size
+
+        fileList.sort()
+        for mtime, size, fullfn in fileList:
+            if totalSize <= self._maxSize:
+                break
+            try:
+                os.unlink(fullfn)
+            except FileNotFoundError:
+                pass
+            totalSize -= size
+
+
+class DigestCache:
+
+    """Cache of file content digests, keyed by (st_dev, st_ino, size, mtime_ns)"""
+
+    DEFAULT_MAX_COUNT = 100000
+
+    MMAP_THRESHOLD = 1024 * 1024
+
+    def __init__(self, cache_file=None, max_count=DEFAULT_MAX_COUNT):
+        self._cacheFile = cache_file
+        self._maxCount = max_count
+        self._lock = threading.Lock()
+        self._dict = collections.OrderedDict()
+        self._bDirty = False
+
+        if self._cacheFile is not None:
+            try:
+                with open(self._cacheFile) as f:
+                    for k, v in json.load(f).items():
+                        self._dict[tuple(int(x) for x in k.split(":"))] = bytes.fromhex(v)
+            except (FileNotFoundError, ValueError):
+                pass
+            atexit.register(self.save)
+
+    @property
+    def cache_file(self):
+        return self._cacheFile
+
+    def get_digest(self, path, st=None):
+        if st is None:
+            st = os.stat(path)
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+        with self._lock:
+            ret = self._dict.get(key)
+            if ret is not None:
+                self._dict.move_to_end(key)
+                return ret
+
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            if st.st_size >= self.MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    h.update(m)
+            else:
+                h.update(f.read())
+            st2 = os.fstat(f.fileno())
+        ret = h.digest()
+
+        # don't record the digest if the file is changed during reading
+        if (st2.st_dev, st2.st_ino, st2.st_size, st2.st_mtime_ns) == key:
+            with self._lock:
+                self._dict[key] = ret
+                while len(self._dict) > self._maxCount:
+                    self._dict.popitem(last=False)
+                self._bDirty = True
+        return ret
+
+    def save(self):
+        if self._cacheFile is None:
+            return
+        with self._lock:
+            if not self._bDirty:
+                return
+            data = {":".join(str(x) for x in k): v.hex() for k, v in self._dict.items()}
+            self._bDirty = False
+
+        dirname = os.path.dirname(os.path.abspath(self._cacheFile))
+        fd, tmpFullfn = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmpFullfn, self._cacheFile)
+        except BaseException:
+            os.unlink(tmpFullfn)
+            raise
+
+    def clear(self):
+        with self._lock:
+            self._dict.clear()
+            self._bDirty = True
+
+
+def get_default_digest_cache():
+    return _defaultDigestCache
+
+
+def set_default_digest_cache(digest_cache):
+    global _defaultDigestCache
+    assert isinstance(digest_cache, DigestCache)
+    _defaultDigestCache = digest_cache
+
+
+_defaultDigestCache = DigestCache()
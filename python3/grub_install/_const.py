@@ -28,6 +28,7 @@ class TargetType(enum.Enum):
     MOUNTED_HDD_DEV = enum.auto()            # hard-disk device
     PYCDLIB_OBJ = enum.auto()                # pycdlib object
     ISO_DIR = enum.auto()                    # directory containing files for a ISO
+    DISK_IMAGE_FILE = enum.auto()            # disk image file, with a directory containing files for one of its filesystems
 
 
 class TargetAccessMode(enum.Enum):
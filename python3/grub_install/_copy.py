@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import fcntl
+import errno
+import shutil
+import platform
+import threading
+from ._util import force_rm, force_mkdir, remove_redundant_entries, compare_files, run_in_parallel
+from ._trace import trace_count
+
+
+class CopyEngine:
+
+    """Copy files with copy_file_range()/sendfile() on a bounded worker pool, files with the same content are skipped"""
+
+    def __init__(self, max_workers=None, dedup=False, hardlink=False):
+        self._maxWorkers = max_workers
+        self._bDedup = dedup                            # try reflink before doing real copy
+        self._bHardlink = hardlink                      # also try hardlink after reflink, the copied file shares inode with the source file
+        self._lock = threading.Lock()
+        self._noReflinkSet = set()                      # (src-st_dev, dst-st_dev) that doesn't support reflink
+        self._noHardlinkSet = set()                     # (src-st_dev, dst-st_dev) that doesn't support hardlink
+        self.files_copied = 0
+        self.files_skipped = 0
+        self.files_reflinked = 0
+        self.files_hardlinked = 0
+        self.bytes_copied = 0
+
+    def copy_file(self, src, dst):
+        self.copy_files([(src, dst)])
+
+    def copy_files(self, pair_list):
+        # pair_list is a list of (src-file, dst-file), parent directory of dst-file must exist
+        run_in_parallel([lambda x=x: self._copyFile(x[0], x[1]) for x in pair_list], self._maxWorkers)
+
+    def copy_tree(self, src_dir, dst_dir, mirror=False):
+        # copy a directory tree, entries in dst_dir that are not in src_dir are removed if mirror is True
+        pairList = []
+
+        def __walk(srcDir, dstDir):
+            force_mkdir(dstDir)
+            nameSet = set()
+            for de in os.scandir(srcDir):
+                nameSet.add(de.name)
+                dstPath = os.path.join(dstDir, de.name)
+                if de.is_symlink():
+                    force_rm(dstPath)
+                    os.symlink(os.readlink(de.path), dstPath)
+                elif de.is_dir():
+                    __walk(de.path, dstPath)
+                else:
+                    if os.path.isdir(dstPath) and not os.path.islink(dstPath):
+                        force_rm(dstPath)
+                    pairList.append((de.path, dstPath))
+            if mirror:
+                remove_redundant_entries(dstDir, nameSet)
+            shutil.copystat(srcDir, dstDir)
+
+        __walk(src_dir, dst_dir)
+        self.copy_files(pairList)
+
+    def _copyFile(self, src, dst):
+        # skip if the content is the same
+        if os.path.isfile(dst) and not os.path.islink(dst) and compare_files(src, dst):
+            with self._lock:
+                self.files_skipped += 1
+            trace_count("files_skipped")
+            return
+
+        force_rm(dst)
+        if self._bDedup and self._dedupFile(src, dst):
+            return
+        with open(src, "rb") as fsrc:
+            st = os.fstat(fsrc.fileno())
+            os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)         # advices are values, not flags
+            os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            with open(dst, "wb") as fdst:
+                _copyContent(fsrc.fileno(), fdst.fileno(), st.st_size)
+                os.fchmod(fdst.fileno(), st.st_mode & 0o7777)
+
+        with self._lock:
+            self.files_copied += 1
+            self.bytes_copied += st.st_size
+        trace_count("bytes_copied", st.st_size)
+
+    def _dedupFile(self, src, dst):
+        # dst must not exist
+        devKey = (os.stat(src).st_dev, os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+
+        if devKey not in self._noReflinkSet:
+            try:
+                with open(src, "rb") as fsrc:
+                    with open(dst, "wb") as fdst:
+                        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                        os.fchmod(fdst.fileno(), os.fstat(fsrc.fileno()).st_mode & 0o7777)
+                with self._lock:
+                    self.files_reflinked += 1
+                return True
+            except OSError as e:
+                if e.errno not in [errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.ENOSYS]:
+                    raise
+                force_rm(dst)
+                with self._lock:
+                    self._noReflinkSet.add(devKey)
+
+        if self._bHardlink and devKey not in self._noHardlinkSet:
+            try:
+                os.link(src, dst)
+                with self._lock:
+                    self.files_hardlinked += 1
+                return True
+            except OSError as e:
+                if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP]:
+                    raise
+                with self._lock:
+                    self._noHardlinkSet.add(devKey)
+
+        return False
+
+
+def _iow(ioctlType, nr, size):
+    # _IOW() of linux, the direction bits of ioctl number are architecture dependent
+    machine = platform.machine()
+    if machine.startswith(("ppc", "powerpc", "mips", "sparc", "alpha")):
+        return (4 << 29) | (size << 16) | (ioctlType << 8) | nr
+    elif machine.startswith("parisc"):
+        return (2 << 30) | (size << 16) | (ioctlType << 8) | nr
+    else:
+        return (1 << 30) | (size << 16) | (ioctlType << 8) | nr
+
+
+# _IOW(0x94, 9, int)
+_FICLONE = _iow(0x94, 9, 4)
+
+
+def _copyContent(fdSrc, fdDst, size):
+    # try copy_file_range() (in-kernel, may be offloaded or reflinked by filesystem), then sendfile(), then read()/write()
+    # explicit offsets are used, so file positions are not changed by the first two methods
+    for func in [_copyFileRange, _sendFile]:
+        try:
+            func(fdSrc, fdDst, size)
+            return
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP]:
+                raise
+            os.ftruncate(fdDst, 0)
+
+    os.lseek(fdDst, 0, os.SEEK_SET)
+    while True:
+        buf = os.read(fdSrc, 1024 * 1024)
+        if len(buf) == 0:
+            break
+        while len(buf) > 0:
+            buf = buf[os.write(fdDst, buf):]
+
+
+def _copyFileRange(fdSrc, fdDst, size):
+    offset = 0
+    while offset < size:
+        n = os.copy_file_range(fdSrc, fdDst, size - offset, offset, offset)
+        if n == 0:
+            break                                       # source file is truncated during copy
+        offset += n
+
+
+def _sendFile(fdSrc, fdDst, size):
+    offset = 0
+    while offset < size:
+        n = os.sendfile(fdDst, fdSrc, offset, size - offset)
+        if n == 0:
+            break                                       # source file is truncated during copy
+        offset += n
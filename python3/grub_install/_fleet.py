@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import time
+import functools
+from ._util import run_in_parallel
+from ._source import Source
+from ._target import Target
+
+
+class FleetJob:
+
+    def __init__(self, target, platforms, **kwargs):
+        # platforms and kwargs are the same as the arguments of Target.install_platforms()
+        assert isinstance(target, Target)
+        self.target = target
+        self.platforms = platforms
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.__dict__)
+
+
+class FleetJobResult:
+
+    def __init__(self, job, disk):
+        self.job = job
+        self.disk = disk                    # disk device path, or directory path for ISO_DIR target
+        self.error = None                   # exception raised by this job, None if succeeded
+        self.start_time = None              # time.monotonic() when the job starts
+        self.elapsed = None                 # seconds
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.__dict__)
+
+
+class FleetInstaller:
+
+    """Install to many targets concurrently, jobs on the same disk are run one after another"""
+
+    def __init__(self, source, max_workers=None, core_image_cache=None):
+        assert isinstance(source, Source)
+        self._source = source
+        self._maxWorkers = max_workers
+        self._coreImageCache = core_image_cache
+
+    def run(self, jobs):
+        # returns a list of FleetJobResult in the order of jobs, failure of one job does not affect other jobs
+        resultList = []
+        queueDict = dict()                  # disk -> [FleetJobResult], keeps job order for each disk
+        for job in jobs:
+            if not isinstance(job, FleetJob):
+                job = FleetJob(job[0], job[1], **(job[2] if len(job) > 2 else {}))
+            if self._coreImageCache is not None:
+                job.target.core_image_cache = self._coreImageCache
+            result = FleetJobResult(job, self._getDisk(job.target))
+            resultList.append(result)
+            queueDict.setdefault(result.disk, []).append(result)
+
+        # each disk is a single work item, so there's at most one writer for each disk
+        # jobs run in run_in_parallel() workers, so the parallel work inside each job is done serially and max_workers bounds the total concurrency
+        run_in_parallel([functools.partial(self._runQueue, x) for x in queueDict.values()], self._maxWorkers)
+
+        return resultList
+
+    def _runQueue(self, resultList):
+        for result in resultList:
+            job = result.job
+            result.start_time = time.monotonic()
+            try:
+                job.target.install_platforms(job.platforms, self._source, **job.kwargs)
+            except Exception as e:
+                result.error = e
+            result.elapsed = time.monotonic() - result.start_time
+
+    @staticmethod
+    def _getDisk(target):
+        if target.disk is not None:
+            return target.disk
+        elif target.iso_dir is not None:
+            return target.iso_dir
+        else:
+            return "<%x>" % (id(target))
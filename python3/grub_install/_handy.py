@@ -22,10 +22,18 @@
 
 
 import os
+import re
+import shutil
+import asyncio
+import hashlib
+import functools
 import pathlib
 import tempfile
+import threading
 import subprocess
+import concurrent.futures
 from ._util import PartiUtil
+from ._trace import trace_span, trace_count
 from ._const import PlatformType
 
 
@@ -147,6 +155,9 @@ class Grub:
     # The offset of the end of the partition table.
     BOOT_MACHINE_PART_END = 0x1fe                               # note: this is end+1
 
+    # The offset of the sector number of diskboot.img in boot_hybrid.img.
+    BOOT_MACHINE_HYBRID_KERNEL_SECTOR = 0x1b0
+
     KERNEL_I386_PC_LINK_ADDR = 0x9000
 
     # Offset of reed_solomon_redundancy.
@@ -155,10 +166,26 @@ class Grub:
     # Offset of field holding no reed solomon length.
     KERNEL_I386_PC_NO_REED_SOLOMON_LENGTH = 0x14
 
+    # El Torito image of i386-pc, which is core.img with cdboot.img prepended.
+    ELTORITO_IMG_NAME = "eltorito.img"
+    ELTORITO_MKIMAGE_TARGET = "i386-pc-eltorito"
+
+    # Number of 512-byte sectors of El Torito image loaded by BIOS.
+    ELTORITO_BOOT_LOAD_SIZE = 4
+
+    # The offset of the sector number of the rest of core.img in El Torito image, it's the blocklist of diskboot.img.
+    ELTORITO_GRUB2_BOOT_INFO = 0x9f4
+
     PLATFORM_ADDON_FILES = ["moddep.lst", "command.lst", "fs.lst", "partmap.lst", "parttool.lst", "video.lst", "crypto.lst", "terminal.lst", "modinfo.sh"]
 
     PLATFORM_OPTIONAL_ADDON_FILES = ["efiemu32.o", "efiemu64.o"]
 
+    # lists the user specified modules when only the module dependency closure is installed, all the modules are installed if it doesn't exist
+    MODULE_LIST_FILE_NAME = "install-modules.lst"
+
+    # modules which are not in core.img but loaded from prefix directory by core.img
+    PLATFORM_RUNTIME_MODULES = ["normal"]
+
     @staticmethod
     def getModuleListAndHnits(platform_type, mnt):
         moduleList = []
@@ -198,7 +225,8 @@ class Grub:
             assert False
 
         # partmap module
-        moduleList.append("part_%s" % (mnt.grub_partmap))
+        if mnt.grub_partmap is not None:
+            moduleList.append("part_%s" % (mnt.grub_partmap))
 
         # fs module
         moduleList.append(mnt.grub_fs)
@@ -208,6 +236,48 @@ class Grub:
 
         return (moduleList, hints)
 
+    @staticmethod
+    def parseModDepFile(fullfn):
+        # returns {module-name: [dependent-module-name, ...]}
+        ret = dict()
+        for line in pathlib.Path(fullfn).read_text().split("\n"):
+            if line.strip() == "":
+                continue
+            name, deps = line.split(":", 1)
+            ret[name.strip()] = deps.split()
+        return ret
+
+    @staticmethod
+    def parseModuleMappingFile(fullfn):
+        # for command.lst, crypto.lst, returns {command-or-algorithm-name: module-name}
+        # "*" prefix in command.lst marks an extended command
+        ret = dict()
+        for line in pathlib.Path(fullfn).read_text().split("\n"):
+            if line.strip() == "":
+                continue
+            name, mod = line.split(":", 1)
+            ret[name.strip().lstrip("*")] = mod.strip()
+        return ret
+
+    @staticmethod
+    def parseModuleListFile(fullfn):
+        # for fs.lst, partmap.lst, video.lst, which contains one module name per line
+        return [x.strip() for x in pathlib.Path(fullfn).read_text().split("\n") if x.strip() != ""]
+
+    @staticmethod
+    def getModuleDependencyClosure(modDepDict, moduleList, exceptionClass):
+        ret = set()
+        todoList = list(moduleList)
+        while len(todoList) > 0:
+            name = todoList.pop()
+            if name in ret:
+                continue
+            if name not in modDepDict:
+                raise exceptionClass("module %s does not exist" % (name))
+            ret.add(name)
+            todoList += modDepDict[name]
+        return ret
+
     @staticmethod
     def getCoreImgNameAndTarget(platform_type):
         if platform_type == PlatformType.I386_PC:
@@ -246,22 +316,81 @@ class Grub:
         return (core_name, mkimage_target)
 
     @classmethod
-    def makeCoreImage(cls, source, platform_type, mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage, tmpDir=None):
+    def makeCoreImage(cls, source, platform_type, mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage, tmpDir=None, cache=None):
+        with trace_span("make_core_image", platform=platform_type.value):
+            return cls._makeCoreImageCached(source, platform_type, mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage, tmpDir, cache)
+
+    @classmethod
+    def _makeCoreImageCached(cls, source, platform_type, mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage, tmpDir, cache):
+        if cache is not None:
+            key = cache.make_key(mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage,
+                                 source.get_platform_directory(platform_type), source.get_platform_files(platform_type))
+            ret = cache.get(key)
+            if ret is None:
+                ret = cls._makeCoreImage(source, platform_type, mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage, tmpDir)
+                cache.put(key, ret)
+            return ret
+        else:
+            return cls._makeCoreImage(source, platform_type, mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage, tmpDir)
+
+    @classmethod
+    async def makeCoreImageAsync(cls, source, platform_type, mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage, tmpDir=None, cache=None, executor=None):
+        # same as makeCoreImage(), grub-mkimage is run as an asyncio subprocess, file I/O is done in executor
+        with trace_span("make_core_image", platform=platform_type.value):
+            return await cls._makeCoreImageAsync(source, platform_type, mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage, tmpDir, cache, executor)
+
+    @classmethod
+    async def _makeCoreImageAsync(cls, source, platform_type, mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage, tmpDir, cache, executor):
+        loop = asyncio.get_running_loop()
+
+        if cache is not None:
+            # make_key() reads the files to get their digests
+            key = await loop.run_in_executor(executor, lambda: cache.make_key(mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage,
+                                                                              source.get_platform_directory(platform_type), source.get_platform_files(platform_type)))
+            ret = await loop.run_in_executor(executor, cache.get, key)
+            if ret is not None:
+                return ret
+
+        tdir = await loop.run_in_executor(executor, functools.partial(tempfile.mkdtemp, dir=tmpDir))
+        try:
+            cmd, coreImgFile = await loop.run_in_executor(executor, cls._prepareMakeCoreImage, tdir, source, platform_type, mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage)
+            trace_count("subprocesses")
+            proc = await asyncio.create_subprocess_exec(*cmd)
+            if await proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+            ret = await loop.run_in_executor(executor, pathlib.Path(coreImgFile).read_bytes)
+        finally:
+            await loop.run_in_executor(executor, shutil.rmtree, tdir)
+
+        if cache is not None:
+            await loop.run_in_executor(executor, cache.put, key, ret)
+        return ret
+
+    @classmethod
+    def _makeCoreImage(cls, source, platform_type, mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage, tmpDir):
+        with tempfile.TemporaryDirectory(dir=tmpDir) as tdir:
+            cmd, coreImgFile = cls._prepareMakeCoreImage(tdir, source, platform_type, mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage)
+            trace_count("subprocesses")
+            subprocess.check_call(cmd)
+            return pathlib.Path(coreImgFile).read_bytes()
+
+    @classmethod
+    def _prepareMakeCoreImage(cls, tdir, source, platform_type, mkimage_target, module_list, rootFsUuid, rootHints, prefixDir, bDebugImage):
+        # returns (grub-mkimage command line, output file)
         buf = ""
         if bDebugImage is not None:
             buf += "set debug='%s'\n" % (bDebugImage)
         buf += "search.fs_uuid %s root%s\n" % (rootFsUuid, (" " + rootHints) if rootHints != "" else "")
         buf += "set prefix=($root)'/%s'\n" % (cls.escape(prefixDir))
 
-        with tempfile.TemporaryDirectory(dir=tmpDir) as tdir:
-            loadCfgFile = os.path.join(tdir, "load.cfg")
-            with open(loadCfgFile, "w") as f:
-                f.write(buf)
+        loadCfgFile = os.path.join(tdir, "load.cfg")
+        with open(loadCfgFile, "w") as f:
+            f.write(buf)
 
-            coreImgFile = os.path.join(tdir, "core.img")
-            # "-p" has no use when "set prefix=" is in load.cfg, but this argument is not optional
-            subprocess.check_call(["grub-mkimage", "-c", loadCfgFile, "-p", "", "-O", mkimage_target, "-d", source.get_platform_directory(platform_type), "-o", coreImgFile] + module_list)
-            return pathlib.Path(coreImgFile).read_bytes()
+        coreImgFile = os.path.join(tdir, "core.img")
+        # "-p" has no use when "set prefix=" is in load.cfg, but this argument is not optional
+        cmd = ["grub-mkimage", "-c", loadCfgFile, "-p", "", "-O", mkimage_target, "-d", source.get_platform_directory(platform_type), "-o", coreImgFile] + module_list
+        return (cmd, coreImgFile)
 
     @staticmethod
     def escape(in_str):
@@ -270,31 +399,104 @@ class Grub:
 
 class GrubMountPoint:
 
+    PROBE_KEYS = ["fs_uuid", "fs", "partmap", "bios_hints", "efi_hints"]
+
+    _probeCache = dict()
+    _probeCacheLock = threading.Lock()
+
     def __init__(self, p, rootfs_or_boot):
         self._p = p
 
-        def __getGrub(key):
-            try:
-                return subprocess.check_output(["grub-probe", "-t", key, "-d", self._p.device], universal_newlines=True).rstrip("\n")
-            except subprocess.CalledProcessError:
-                return None
-
         # FIXME: what if filesystem is on raw block device
         self.disk = PartiUtil.partiToDisk(self._p.device)
 
-        self.fs_uuid = __getGrub("fs_uuid")
+        probeResult = self._probe(self._p.device, self._p.mountpoint)
 
-        self.grub_fs = __getGrub("fs")
+        self.fs_uuid = probeResult["fs_uuid"]
+
+        self.grub_fs = probeResult["fs"]
 
         # FIXME: what if filesystem is on raw block device
-        self.grub_partmap = __getGrub("partmap")
+        self.grub_partmap = probeResult["partmap"]
 
-        self.grub_bios_hints = __getGrub("bios_hints")
+        self.grub_bios_hints = probeResult["bios_hints"]
 
-        self.grub_efi_hints = __getGrub("efi_hints")
+        self.grub_efi_hints = probeResult["efi_hints"]
 
         self._rootfs_or_boot = rootfs_or_boot
 
+    @classmethod
+    def invalidate_cache(cls, device=None):
+        with cls._probeCacheLock:
+            if device is None:
+                cls._probeCache.clear()
+            else:
+                cls._probeCache.pop(device, None)
+
+    @classmethod
+    def _probe(cls, device, mountpoint):
+        with trace_span("grub_probe", device=device):
+            return cls._probeCached(device, mountpoint)
+
+    @classmethod
+    def _probeCached(cls, device, mountpoint):
+        # probe result is valid as long as the device node, the mount and the filesystem superblock are unchanged
+        signature = cls._getProbeSignature(device, mountpoint)
+        with cls._probeCacheLock:
+            if device in cls._probeCache and cls._probeCache[device][0] == signature:
+                return cls._probeCache[device][1]
+
+        def __getGrub(key):
+            try:
+                return subprocess.check_output(["grub-probe", "-t", key, "-d", device], universal_newlines=True).rstrip("\n")
+            except subprocess.CalledProcessError:
+                return None
+
+        trace_count("subprocesses", len(cls.PROBE_KEYS))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(cls.PROBE_KEYS)) as executor:
+            ret = dict(zip(cls.PROBE_KEYS, executor.map(__getGrub, cls.PROBE_KEYS)))
+
+        with cls._probeCacheLock:
+            cls._probeCache[device] = (signature, ret)
+        return ret
+
+    @classmethod
+    async def prefetch_probe(cls, device, mountpoint, executor=None):
+        # run grub-probe as asyncio subprocesses and fill the probe cache, so that creating GrubMountPoint doesn't block on grub-probe
+        loop = asyncio.get_running_loop()
+        signature = await loop.run_in_executor(executor, cls._getProbeSignature, device, mountpoint)
+        with cls._probeCacheLock:
+            if device in cls._probeCache and cls._probeCache[device][0] == signature:
+                return
+
+        async def __getGrub(key):
+            proc = await asyncio.create_subprocess_exec("grub-probe", "-t", key, "-d", device, stdout=asyncio.subprocess.PIPE)
+            out = (await proc.communicate())[0]
+            if proc.returncode != 0:
+                return None
+            return out.decode().rstrip("\n")
+
+        ret = dict(zip(cls.PROBE_KEYS, await asyncio.gather(*[__getGrub(k) for k in cls.PROBE_KEYS])))
+
+        with cls._probeCacheLock:
+            cls._probeCache[device] = (signature, ret)
+
+    @staticmethod
+    def _getProbeSignature(device, mountpoint):
+        # f_fsid is derived from the superblock (filesystem uuid) on most linux filesystems
+        # mount id changes on every mount
+        # partmap and hints depend on the partition table, MBR and GPT header (which has the CRC32 of GPT entries) are in the first 8KiB for all sector sizes
+        mountId = None
+        bMountpoint = os.fsencode(mountpoint)
+        with open("/proc/self/mountinfo", "rb") as f:
+            for line in f:
+                items = line.split(b" ")
+                if re.sub(rb"\\([0-7]{3})", lambda m: bytes([int(m.group(1), 8)]), items[4]) == bMountpoint:     # space, tab, newline and backslash are octal escaped
+                    mountId = items[0]                          # don't break, the last one is the visible mount
+        with open(PartiUtil.partiToDisk(device), "rb") as f:
+            partTableDigest = hashlib.sha256(f.read(8192)).digest()
+        return (os.stat(device).st_rdev, mountId, os.statvfs(mountpoint).f_fsid, partTableDigest)
+
     @property
     def device(self):
         return self._p.device
@@ -316,3 +518,40 @@ class GrubMountPoint:
 
     def is_boot_mount_point(self):
         return not self._rootfs_or_boot
+
+
+class GrubStaticMountPoint:
+
+    """Same interface as GrubMountPoint, but all the values are specified instead of being probed"""
+
+    def __init__(self, mountpoint, fs_uuid, grub_fs, grub_partmap, grub_bios_hints, grub_efi_hints, rootfs_or_boot, disk=None):
+        self.disk = disk
+        self.fs_uuid = fs_uuid
+        self.grub_fs = grub_fs
+        self.grub_partmap = grub_partmap
+        self.grub_bios_hints = grub_bios_hints
+        self.grub_efi_hints = grub_efi_hints
+        self._mountpoint = mountpoint
+        self._rootfs_or_boot = rootfs_or_boot
+
+    @property
+    def device(self):
+        return None
+
+    @property
+    def mountpoint(self):
+        return self._mountpoint
+
+    @property
+    def fstype(self):
+        return None
+
+    @property
+    def opts(self):
+        return None
+
+    def is_rootfs_mount_point(self):
+        return self._rootfs_or_boot
+
+    def is_boot_mount_point(self):
+        return not self._rootfs_or_boot
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import abc
+import hashlib
+import threading
+import collections
+try:
+    import creedsolo as _reedsolo                   # compiled codec, shipped with reedsolo when built with cython
+except ImportError:
+    import reedsolo as _reedsolo
+
+
+class RsEngine(abc.ABC):
+
+    """Interface of a Reed-Solomon encoder, the code is the one used by GRUB: GF(2^8) with primitive polynomial 0x11d, generator 2, first consecutive root 1"""
+
+    @property
+    @abc.abstractmethod
+    def name(self):
+        pass
+
+    @abc.abstractmethod
+    def encode(self, buf, nsym):
+        # returns buf + nsym bytes of error correction codes, len(buf) + nsym never exceeds 255
+        pass
+
+
+class ReedsoloRsEngine(RsEngine):
+
+    def __init__(self, module=_reedsolo):
+        self._module = module
+        self._lock = threading.Lock()
+        self._codecDict = dict()                    # nsym -> RSCodec, so that generator polynomials are computed only once
+
+    @property
+    def name(self):
+        return self._module.__name__
+
+    def encode(self, buf, nsym):
+        with self._lock:
+            rsc = self._codecDict.get(nsym)
+            if rsc is None:
+                rsc = self._module.RSCodec(nsym)
+                self._codecDict[nsym] = rsc
+        return bytes(rsc.encode(bytearray(buf)))
+
+
+class RsEncodeCache:
+
+    """LRU cache of encoded buffers, keyed by the digest of the input"""
+
+    DEFAULT_MAX_COUNT = 16
+
+    def __init__(self, max_count=DEFAULT_MAX_COUNT):
+        self._maxCount = max_count
+        self._lock = threading.Lock()
+        self._dict = collections.OrderedDict()
+
+    def encode(self, engine, buf, redundancy):
+        key = (engine.name, hashlib.sha256(buf).digest(), redundancy)
+        with self._lock:
+            ret = self._dict.get(key)
+            if ret is not None:
+                self._dict.move_to_end(key)
+                return ret
+
+        ret = _addRedundancy(engine, buf, redundancy)
+
+        with self._lock:
+            self._dict[key] = ret
+            while len(self._dict) > self._maxCount:
+                self._dict.popitem(last=False)
+        return ret
+
+    def clear(self):
+        with self._lock:
+            self._dict.clear()
+
+
+def get_rs_engine():
+    return _rsEngine
+
+
+def set_rs_engine(engine):
+    global _rsEngine
+    assert isinstance(engine, RsEngine)
+    _rsEngine = engine
+
+
+def rs_encode(buf, redundancy):
+    # returns buf + redundancy bytes of error correction codes, same as grub_reed_solomon_add_redundancy()
+    return _rsEncodeCache.encode(_rsEngine, buf, redundancy)
+
+
+def _addRedundancy(engine, buf, redundancy):
+    # buf is split into blocks of at most 200 sectors (data and codes together), see grub's lib/reed_solomon.c
+    ret = bytearray(buf) + bytearray(redundancy)
+    s, rs = len(buf), redundancy
+    ptr, rptr = 0, len(buf)
+    if rs == 0:
+        return bytes(ret)
+    while s > 0:
+        cs, crs = s, rs
+        tt = cs + crs
+        if tt > _MAX_BLOCK_SIZE:
+            cs = ((cs * (_MAX_BLOCK_SIZE // _SECTOR_SIZE)) // tt) * _SECTOR_SIZE
+            crs = ((crs * (_MAX_BLOCK_SIZE // _SECTOR_SIZE)) // tt) * _SECTOR_SIZE
+            assert cs > 0
+        _encodeBlock(engine, ret, ptr, cs, rptr, crs)
+        ptr += cs
+        rptr += crs
+        s -= cs
+        rs -= crs
+    return bytes(ret)
+
+
+def _encodeBlock(engine, buf, ptr, s, rptr, rs):
+    # bytes at the same offset of each sector are encoded as one codeword, so that a bad sector damages only one symbol of each codeword
+    for i in range(_SECTOR_SIZE):
+        ds = (s + _SECTOR_SIZE - 1 - i) // _SECTOR_SIZE
+        rr = (rs + _SECTOR_SIZE - 1 - i) // _SECTOR_SIZE
+        if ds == 0 or rr == 0:
+            continue
+        buf[rptr + i:rptr + rs:_SECTOR_SIZE] = engine.encode(bytes(buf[ptr + i:ptr + s:_SECTOR_SIZE]), rr)[ds:]
+
+
+_SECTOR_SIZE = 512
+
+_MAX_BLOCK_SIZE = 200 * _SECTOR_SIZE
+
+_rsEngine = ReedsoloRsEngine()
+
+_rsEncodeCache = RsEncodeCache()
@@ -22,11 +22,16 @@
 
 
 import os
-import glob
-import shutil
+import json
+import hashlib
+import tempfile
+import threading
 from ._util import rel_path, compare_files, compare_directories
 from ._const import PlatformType
 from ._errors import SourceError, CopySourceError
+from ._handy import Grub
+from ._copy import CopyEngine
+from ._trace import trace_span
 
 
 class Source:
@@ -35,7 +40,8 @@ class Source:
     CAP_FONTS = 2
     CAP_THEMES = 3
 
-    def __init__(self, base_dir=None):
+    def __init__(self, base_dir=None, index_cache_dir=None, index_digests=False, index_strict=False, tracer=None):
+        self._tracer = tracer
         if base_dir is not None:
             self._baseDir = base_dir
         else:
@@ -50,26 +56,30 @@ class Source:
             raise SourceError("directory %s does not exist" % (self._libDir))
         if not os.path.isdir(self._shareDir):
             raise SourceError("directory %s does not exist" % (self._shareDir))
-        self.get_all_platform_directories()
+
+        # all the files are indexed by one scan, the index is persisted in index_cache_dir
+        # the persisted index is validated by directory mtimes, index_strict also checks size and mtime of every indexed file, which detects in-place rewrites
+        with trace_span("source_init", self._tracer, base_dir=self._baseDir):
+            self._index = _FileIndex(self, index_cache_dir, index_digests, index_strict)
+
+        # module index is loaded lazily for each platform
+        self._moduleIndexDict = dict()
+        self._moduleIndexLock = threading.Lock()
 
     def supports(self, key):
         if key == self.CAP_NLS:
-            return os.path.exists(self._localeDir)
+            return self._index.data["locales"] is not None
         elif key == self.CAP_FONTS:
-            return len(glob.glob(os.path.join(self._shareDir, "*.pf2"))) > 0
+            return len(self._index.data["fonts"]) > 0
         elif key == self.CAP_THEMES:
-            return os.path.exists(self._themesDir)
+            return self._index.data["themes"] is not None
         else:
             assert False
 
     def get_all_platform_directories(self):
         ret = dict()
-        for fullfn in glob.glob(os.path.join(self._libDir, "*")):
-            n = os.path.basename(fullfn)
-            try:
-                ret[PlatformType(n)] = fullfn
-            except ValueError:
-                raise SourceError("invalid platform directory %s" % (fullfn))
+        for n in self._index.data["platforms"]:
+            ret[PlatformType(n)] = os.path.join(self._libDir, n)
         return ret
 
     def get_platform_directory(self, platform_type):
@@ -79,19 +89,49 @@ class Source:
 
     def try_get_platform_directory(self, platform_type):
         assert isinstance(platform_type, PlatformType)
-        ret = os.path.join(self._libDir, platform_type.value)
-        if os.path.exists(ret):
-            assert os.path.isdir(ret)
-            return ret
+        if platform_type.value in self._index.data["platforms"]:
+            return os.path.join(self._libDir, platform_type.value)
+        else:
+            return None
+
+    def get_platform_files(self, platform_type):
+        # returns {filename: (size, mtime_ns, digest-or-None)}
+        return {k: tuple(v) for k, v in self._index.data["platforms"][platform_type.value].items()}
+
+    def get_module_dependency_closure(self, platform_type, module_names):
+        ret = set()
+        index = self._getModuleIndex(platform_type)
+        for name in module_names:
+            ret |= index.getClosure(name)
+        return ret
+
+    def try_get_command_module(self, platform_type, command_name):
+        return self._getModuleIndex(platform_type).commandDict.get(command_name)
+
+    def try_get_fs_module(self, platform_type, grub_fs):
+        if grub_fs in self._getModuleIndex(platform_type).fsSet:
+            return grub_fs
         else:
             return None
 
+    def try_get_partmap_module(self, platform_type, grub_partmap):
+        name = "part_%s" % (grub_partmap)
+        if name in self._getModuleIndex(platform_type).partmapSet:
+            return name
+        else:
+            return None
+
+    def try_get_crypto_module(self, platform_type, algorithm_name):
+        return self._getModuleIndex(platform_type).cryptoDict.get(algorithm_name)
+
+    def get_video_modules(self, platform_type):
+        return sorted(self._getModuleIndex(platform_type).videoSet)
+
     def get_all_locale_files(self):
         assert self.supports(self.CAP_NLS)
         ret = dict()
-        for fullfn in glob.glob(os.path.join(self._localeDir, "**/LC_MESSAGES/grub.mo")):
-            n = rel_path(self._localeDir, fullfn).split("/")[0]
-            ret[n] = fullfn
+        for n in self._index.data["locales"]:
+            ret[n] = os.path.join(self._localeDir, n, "LC_MESSAGES", "grub.mo")
         return ret
 
     def get_locale_file(self, locale_name):
@@ -101,19 +141,16 @@ class Source:
 
     def try_get_locale_file(self, locale_name):
         assert self.supports(self.CAP_NLS)
-        ret = os.path.join(self._localeDir, locale_name, "LC_MESSAGES", "grub.mo")
-        if os.path.exists(ret):
-            assert os.path.isfile(ret)
-            return ret
+        if locale_name in self._index.data["locales"]:
+            return os.path.join(self._localeDir, locale_name, "LC_MESSAGES", "grub.mo")
         else:
             return None
 
     def get_all_font_files(self):
         assert self.supports(self.CAP_FONTS)
         ret = dict()
-        for fullfn in glob.glob(os.path.join(self._shareDir, "*.pf2")):
-            n = os.path.basename(fullfn).replace(".pf2", "")
-            ret[n] = fullfn
+        for n in self._index.data["fonts"]:
+            ret[n] = os.path.join(self._shareDir, n + ".pf2")
         return ret
 
     def get_font_file(self, font_name):
@@ -123,10 +160,8 @@ class Source:
 
     def try_get_font_file(self, font_name):
         assert self.supports(self.CAP_FONTS)
-        ret = os.path.join(self._shareDir, font_name + ".pf2")
-        if os.path.exists(ret):
-            assert os.path.isfile(ret)
-            return ret
+        if font_name in self._index.data["fonts"]:
+            return os.path.join(self._shareDir, font_name + ".pf2")
         else:
             return None
 
@@ -137,9 +172,8 @@ class Source:
     def get_all_theme_directories(self):
         assert self.supports(self.CAP_THEMES)
         ret = dict()
-        for fullfn in glob.glob(os.path.join(self._themesDir, "*")):
-            n = os.path.basename(fullfn)
-            ret[n] = fullfn
+        for n in self._index.data["themes"]:
+            ret[n] = os.path.join(self._themesDir, n)
         return ret
 
     def get_theme_directory(self, theme_name):
@@ -149,10 +183,8 @@ class Source:
 
     def try_get_theme_directory(self, theme_name):
         assert self.supports(self.CAP_THEMES)
-        ret = os.path.join(self._themesDir, theme_name)
-        if os.path.exists(ret):
-            assert os.path.isdir(ret)
-            return ret
+        if theme_name in self._index.data["themes"]:
+            return os.path.join(self._themesDir, theme_name)
         else:
             return None
 
@@ -160,19 +192,29 @@ class Source:
         assert self.supports(self.CAP_THEMES)
         return "starfield"
 
-    def copy_into(self, dest_dir):
+    def copy_into(self, dest_dir, sync=False, max_workers=None):
+        # existing files that are different from source raise CopySourceError, unless sync is True, in which case they are overwritten
         assert os.path.isdir(dest_dir)
 
+        with trace_span("copy_into", self._tracer, dest_dir=dest_dir):
+            self._copyInto(dest_dir, sync, max_workers)
+
+    def _copyInto(self, dest_dir, sync, max_workers):
+
+        copyEngine = CopyEngine(max_workers)
+        pairList = []
+        treeList = []
+
         # copy platform directories
         tdir = os.path.join(dest_dir, rel_path(self._baseDir, self._libDir))
         os.makedirs(tdir, exist_ok=True)
         for fullfn in self.get_all_platform_directories().values():
             fullfn2 = os.path.join(tdir, rel_path(self._libDir, fullfn))
-            if os.path.exists(fullfn2):
+            if os.path.exists(fullfn2) and not sync:
                 if not compare_directories(fullfn, fullfn2):
                     raise CopySourceError("%s and %s are different" % (fullfn, fullfn2))
             else:
-                shutil.copytree(fullfn, fullfn2)
+                treeList.append((fullfn, fullfn2))
 
         # copy locale files
         if self.supports(self.CAP_NLS):
@@ -180,12 +222,12 @@ class Source:
             os.makedirs(tdir, exist_ok=True)
             for fullfn in self.get_all_locale_files().values():
                 fullfn2 = os.path.join(tdir, rel_path(self._localeDir, fullfn))
-                if os.path.exists(fullfn2):
+                if os.path.exists(fullfn2) and not sync:
                     if not compare_files(fullfn, fullfn2):
                         raise CopySourceError("%s and %s are different" % (fullfn, fullfn2))
                 else:
                     os.makedirs(os.path.dirname(fullfn2), exist_ok=True)
-                    shutil.copy(fullfn, fullfn2)
+                    pairList.append((fullfn, fullfn2))
 
         # copy font files
         if self.supports(self.CAP_FONTS):
@@ -193,11 +235,11 @@ class Source:
             os.makedirs(tdir, exist_ok=True)
             for fullfn in self.get_all_font_files().values():
                 fullfn2 = os.path.join(tdir, rel_path(self._shareDir, fullfn))
-                if os.path.exists(fullfn2):
+                if os.path.exists(fullfn2) and not sync:
                     if not compare_files(fullfn, fullfn2):
                         raise CopySourceError("%s and %s are different" % (fullfn, fullfn2))
                 else:
-                    shutil.copy(fullfn, fullfn2)
+                    pairList.append((fullfn, fullfn2))
 
         # copy theme directories
         if self.supports(self.CAP_THEMES):
@@ -205,8 +247,183 @@ class Source:
             os.makedirs(tdir, exist_ok=True)
             for fullfn in self.get_all_theme_directories().values():
                 fullfn2 = os.path.join(tdir, rel_path(self._themesDir, fullfn))
-                if os.path.exists(fullfn2):
+                if os.path.exists(fullfn2) and not sync:
                     if not compare_directories(fullfn, fullfn2):
                         raise CopySourceError("%s and %s are different" % (fullfn, fullfn2))
                 else:
-                    shutil.copytree(fullfn, fullfn2)
+                    treeList.append((fullfn, fullfn2))
+
+        # do copy, files with the same content are skipped
+        copyEngine.copy_files(pairList)
+        for fullfn, fullfn2 in treeList:
+            copyEngine.copy_tree(fullfn, fullfn2, mirror=True)
+
+    def _getModuleIndex(self, platform_type):
+        with self._moduleIndexLock:
+            ret = self._moduleIndexDict.get(platform_type)
+            if ret is None:
+                ret = _ModuleIndex(self.get_platform_directory(platform_type))
+                self._moduleIndexDict[platform_type] = ret
+            return ret
+
+
+class _FileIndex:
+
+    VERSION = 2
+
+    def __init__(self, source, cacheDir, bDigest, bStrict):
+        self._src = source
+        self._bDigest = bDigest
+        self._bStrict = bStrict
+
+        if cacheDir is not None:
+            key = hashlib.sha256(os.path.abspath(self._src._baseDir).encode("utf-8")).hexdigest()
+            cacheFile = os.path.join(cacheDir, "source-index-%s.json" % (key))
+            with trace_span("load_index"):
+                self.data = self._load(cacheFile)
+            if self.data is None:
+                with trace_span("scan"):
+                    self.data = self._scan()
+                with trace_span("save_index"):
+                    self._save(cacheDir, cacheFile)
+        else:
+            with trace_span("scan"):
+                self.data = self._scan()
+
+    def _load(self, cacheFile):
+        try:
+            with open(cacheFile) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if data.get("version") != self.VERSION or data.get("digest") != self._bDigest:
+            return None
+
+        # cache key is the mtime of all the indexed directories, which detects added and removed files
+        for path, mtime in data["dir_mtimes"].items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return None
+            except FileNotFoundError:
+                return None
+
+        # files rewritten in place don't change the mtime of their directory, it costs one stat() per file to detect them
+        if not self._bStrict:
+            return data
+        fileList = []
+        for platName, fileDict in data["platforms"].items():
+            fileList += [(os.path.join(self._src._libDir, platName, fn), v) for fn, v in fileDict.items()]
+        if data["locales"] is not None:
+            fileList += [(os.path.join(self._src._localeDir, name, "LC_MESSAGES", "grub.mo"), v) for name, v in data["locales"].items()]
+        fileList += [(os.path.join(self._src._shareDir, name + ".pf2"), v) for name, v in data["fonts"].items()]
+        for fullfn, v in fileList:
+            try:
+                st = os.stat(fullfn)
+            except FileNotFoundError:
+                return None
+            if st.st_size != v[0] or st.st_mtime_ns != v[1]:
+                return None
+
+        return data
+
+    def _save(self, cacheDir, cacheFile):
+        os.makedirs(cacheDir, exist_ok=True)
+        fd, tmpFullfn = tempfile.mkstemp(dir=cacheDir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.data, f)
+            os.replace(tmpFullfn, cacheFile)
+        except BaseException:
+            os.unlink(tmpFullfn)
+            raise
+
+    def _scan(self):
+        data = {
+            "version": self.VERSION,
+            "digest": self._bDigest,
+            "dir_mtimes": dict(),
+            "platforms": dict(),
+            "locales": None,
+            "fonts": dict(),
+            "themes": None,
+        }
+
+        def __scandir(path):
+            data["dir_mtimes"][path] = os.stat(path).st_mtime_ns
+            return sorted(os.scandir(path), key=lambda x: x.name)
+
+        def __fileInfo(fullfn):
+            st = os.stat(fullfn)
+            if self._bDigest:
+                h = hashlib.sha256()
+                with open(fullfn, "rb") as f:
+                    for buf in iter(lambda: f.read(1024 * 1024), b""):
+                        h.update(buf)
+                return [st.st_size, st.st_mtime_ns, h.hexdigest()]
+            else:
+                return [st.st_size, st.st_mtime_ns, None]
+
+        # platform directories
+        for de in __scandir(self._src._libDir):
+            try:
+                PlatformType(de.name)
+            except ValueError:
+                raise SourceError("invalid platform directory %s" % (de.path))
+            if de.is_dir():
+                data["platforms"][de.name] = {x.name: __fileInfo(x.path) for x in __scandir(de.path) if x.is_file()}
+
+        # locale files
+        if os.path.isdir(self._src._localeDir):
+            data["locales"] = dict()
+            for de in __scandir(self._src._localeDir):
+                if not de.is_dir():
+                    continue
+                dirpath = os.path.join(de.path, "LC_MESSAGES")
+                if os.path.isdir(dirpath):
+                    data["dir_mtimes"][dirpath] = os.stat(dirpath).st_mtime_ns      # grub.mo may be added into LC_MESSAGES directory later
+                fullfn = os.path.join(dirpath, "grub.mo")
+                if os.path.isfile(fullfn):
+                    data["locales"][de.name] = __fileInfo(fullfn)
+
+        # font files
+        for de in __scandir(self._src._shareDir):
+            if de.name.endswith(".pf2") and de.is_file():
+                data["fonts"][de.name[:-len(".pf2")]] = __fileInfo(de.path)
+
+        # theme directories
+        if os.path.isdir(self._src._themesDir):
+            data["themes"] = [de.name for de in __scandir(self._src._themesDir) if de.is_dir()]
+
+        return data
+
+
+class _ModuleIndex:
+
+    def __init__(self, platDir):
+        def __parse(parseFunc, fn):
+            fullfn = os.path.join(platDir, fn)
+            try:
+                return parseFunc(fullfn)
+            except FileNotFoundError:
+                raise SourceError("%s does not exist" % (fullfn))
+            except ValueError:
+                raise SourceError("invalid format of %s" % (fullfn))
+
+        self.modDepDict = __parse(Grub.parseModDepFile, "moddep.lst")
+        self.commandDict = __parse(Grub.parseModuleMappingFile, "command.lst")
+        self.fsSet = set(__parse(Grub.parseModuleListFile, "fs.lst"))
+        self.partmapSet = set(__parse(Grub.parseModuleListFile, "partmap.lst"))
+        self.videoSet = set(__parse(Grub.parseModuleListFile, "video.lst"))
+        self.cryptoDict = __parse(Grub.parseModuleMappingFile, "crypto.lst")
+
+        self._closureDict = dict()
+        self._closureLock = threading.Lock()
+
+    def getClosure(self, name):
+        with self._closureLock:
+            ret = self._closureDict.get(name)
+            if ret is None:
+                ret = frozenset(Grub.getModuleDependencyClosure(self.modDepDict, [name], SourceError))
+                self._closureDict[name] = ret
+            return ret
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import ctypes
+import threading
+
+
+class SyncTracker:
+
+    """Record the paths and block devices written by an operation, and make them durable with one syncfs() per filesystem and one fdatasync() per block device"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pathSet = set()
+        self._devSet = set()
+
+    def add_path(self, path):
+        # path can be a file or a directory, removed path is also accepted
+        with self._lock:
+            self._pathSet.add(os.path.abspath(path))
+
+    def add_device(self, dev):
+        with self._lock:
+            self._devSet.add(dev)
+
+    def commit(self):
+        with self._lock:
+            pathList = sorted(self._pathSet)
+            devList = sorted(self._devSet)
+            self._pathSet.clear()
+            self._devSet.clear()
+
+        # one representative path for each filesystem
+        fsDict = dict()
+        for path in pathList:
+            while True:
+                try:
+                    st = os.stat(path)
+                    break
+                except FileNotFoundError:
+                    path = os.path.dirname(path)        # removed entry, the directory which contained it is on the same filesystem
+            fsDict.setdefault(st.st_dev, path)
+
+        for path in fsDict.values():
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                _syncfs(fd)
+            finally:
+                os.close(fd)
+
+        for dev in devList:
+            fd = os.open(dev, os.O_RDONLY)
+            try:
+                os.fdatasync(fd)
+            finally:
+                os.close(fd)
+
+
+def _syncfs(fd):
+    if _libc is None or not hasattr(_libc, "syncfs"):
+        os.sync()                                       # no syncfs() available, fall back to global sync
+        return
+    if _libc.syncfs(fd) != 0:
+        errNo = ctypes.get_errno()
+        raise OSError(errNo, os.strerror(errNo))
+
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    _libc = None
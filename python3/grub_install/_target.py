@@ -26,12 +26,18 @@ import glob
 import shutil
 import struct
 import parted
+import functools
+import threading
 import pathlib
-import reedsolo
-from ._util import rel_path, force_rm, force_mkdir, rmdir_if_empty, compare_file_and_content, compare_files, compare_directories, is_buffer_all_zero, PartiUtil
+from ._util import rel_path, force_rm, force_mkdir, rmdir_if_empty, remove_redundant_entries, compare_file_and_content, compare_files, compare_directories, is_buffer_all_zero, find_first_non_zero_byte, SectorSnapshot, PyCdLibFs, run_in_parallel, PartiUtil
 from ._const import TargetType, TargetAccessMode, PlatformType, PlatformInstallInfo
-from ._errors import TargetError, InstallError, CompareWithSourceError
-from ._handy import Handy, Grub, GrubMountPoint
+from ._errors import SourceError, TargetError, InstallError, CompareWithSourceError
+from ._handy import Handy, Grub, GrubMountPoint, GrubStaticMountPoint
+from ._reedsolomon import rs_encode
+from ._cache import CoreImageCache
+from ._copy import CopyEngine
+from ._sync import SyncTracker
+from ._trace import trace_span
 from ._source import Source
 
 
@@ -44,70 +50,79 @@ class Target:
         self._targetType = target_type
         self._mode = target_access_mode
         self._tmpDir = kwargs.get("tmp_work_dir", None)
-
-        # target specific variables
-        if self._targetType == TargetType.MOUNTED_HDD_DEV:
-            rootfsMnt = kwargs["rootfs_mount_point"]
-            bootMnt = kwargs.get("boot_mount_point", None)
-            if bootMnt is None:
-                self._mnt = GrubMountPoint(rootfsMnt, True)
-                self._bootDir = os.path.join(self._mnt.mountpoint, "boot")
-            else:
-                self._mnt = GrubMountPoint(bootMnt, False)
-                self._bootDir = self._mnt.mountpoint
-        elif self._targetType == TargetType.PYCDLIB_OBJ:
-            assert self._mode in [TargetAccessMode.R, TargetAccessMode.W]
-            self._iso = kwargs.get["obj"]
-        elif self._targetType == TargetType.ISO_DIR:
-            self._dir = kwargs["dir"]
-            self._bootDir = os.path.join(self._dir, "boot")
-        else:
-            assert False
-
-        # fill self._platforms
-        self._platforms = dict()
-        if self._mode in [TargetAccessMode.R, TargetAccessMode.RW]:
+        self._coreImageCache = kwargs.get("core_image_cache", _defaultCoreImageCache)
+        self._copyEngine = CopyEngine(kwargs.get("copy_max_workers", None), kwargs.get("dedup", False), kwargs.get("hardlink", False))
+        assert not kwargs.get("dedup", False) or self._targetType == TargetType.ISO_DIR
+        assert not kwargs.get("hardlink", False) or kwargs.get("dedup", False)                 # hardlinked files share inode with Source
+        self._syncTracker = SyncTracker() if kwargs.get("durable", False) else None       # make each write operation durable when it returns
+        self._diskInfoCache = _DiskInfoCache()
+        self._tracer = kwargs.get("tracer", None)                                          # Tracer object, tracing is disabled if it's None
+
+        with trace_span("target_init", self._tracer, target_type=self._targetType.name):
+            # target specific variables
             if self._targetType == TargetType.MOUNTED_HDD_DEV:
-                _Common.init_platforms(self)
-                for k, v in self._platforms.items():
-                    try:
-                        if k == PlatformType.I386_PC:
-                            _Bios.fill_platform_install_info_with_mbr(k, v, self._bootDir, self._mnt.disk)
-                        elif Handy.isPlatformEfi(k):
-                            _Efi.fill_platform_install_info(k, v, self._targetType, self._mnt.mountpoint, self._bootDir)
-                        else:
-                            assert False
-                    except TargetError as e:
-                        self._platforms[k] = _newNotValidPlatformInstallInfo(str(e))
+                rootfsMnt = kwargs["rootfs_mount_point"]
+                bootMnt = kwargs.get("boot_mount_point", None)
+                if bootMnt is None:
+                    self._mnt = GrubMountPoint(rootfsMnt, True)
+                    self._bootDir = os.path.join(self._mnt.mountpoint, "boot")
+                else:
+                    self._mnt = GrubMountPoint(bootMnt, False)
+                    self._bootDir = self._mnt.mountpoint
+                self._diskOffset = 0
             elif self._targetType == TargetType.PYCDLIB_OBJ:
-                _PyCdLib.init_platforms(self)
-                for k, v in self._platforms.items():
-                    try:
-                        if k == PlatformType.I386_PC:
-                            # FIXME
-                            assert False
-                        elif Handy.isPlatformEfi(k):
-                            # FIXME
-                            assert False
-                        else:
-                            assert False
-                    except TargetError as e:
-                        self._platforms[k] = _newNotValidPlatformInstallInfo(str(e))
+                # files are added into the Rock Ridge name space of the pycdlib object, which is required by grub, paths below are paths in the ISO
+                # fs_uuid is the ISO volume uuid, see ISO_DIR
+                assert self._mode in [TargetAccessMode.R, TargetAccessMode.W]
+                assert self._syncTracker is None
+                self._iso = kwargs["obj"]
+                if not self._iso.has_rock_ridge():
+                    raise TargetError("pycdlib object must have Rock Ridge extension")
+                self._isoFs = PyCdLibFs(self._iso)
+                self._isoHybridMbr = None                   # content of boot_hybrid.img, it's patched into the ISO by self.write_iso()
+                self._bootDir = "/boot"
+                self._mnt = GrubStaticMountPoint("/", kwargs.get("fs_uuid", None), "iso9660", None, "", "", True)
+            elif self._targetType == TargetType.DISK_IMAGE_FILE:
+                # the disk image is at image_offset of image_file, files are installed into rootfs_dir or boot_dir, which are staged for the
+                # filesystem, grub-probe can't be used so fs_uuid (filesystem uuid) and fs (grub filesystem module name) must be specified
+                assert kwargs.get("image_offset", 0) % Grub.DISK_SECTOR_SIZE == 0
+                rootfsDir = kwargs.get("rootfs_dir", None)
+                bootDir = kwargs.get("boot_dir", None)
+                if rootfsDir is None and bootDir is None:
+                    raise TargetError("one of rootfs_dir and boot_dir must be specified")
+                if not os.path.isdir(bootDir if bootDir is not None else rootfsDir):
+                    raise TargetError("directory \"%s\" does not exist" % (bootDir if bootDir is not None else rootfsDir))
+                args = [kwargs["fs_uuid"], kwargs["fs"], kwargs.get("partmap", "msdos"), kwargs.get("bios_hints", ""), kwargs.get("efi_hints", "")]
+                if bootDir is None:
+                    self._mnt = GrubStaticMountPoint(rootfsDir, *args, True, disk=kwargs["image_file"])
+                    self._bootDir = os.path.join(self._mnt.mountpoint, "boot")
+                else:
+                    self._mnt = GrubStaticMountPoint(bootDir, *args, False, disk=kwargs["image_file"])
+                    self._bootDir = self._mnt.mountpoint
+                self._diskOffset = kwargs.get("image_offset", 0)
             elif self._targetType == TargetType.ISO_DIR:
-                _Common.init_platforms(self)
-                for k, v in self._platforms.items():
-                    try:
-                        if k == PlatformType.I386_PC:
-                            _Bios.fill_platform_install_info_without_mbr(k, v, self._bootDir)
-                        elif Handy.isPlatformEfi(k):
-                            _Efi.fill_platform_install_info(k, v, self._targetType, self._dir, self._bootDir)
-                        else:
-                            assert False
-                    except TargetError as e:
-                        self._platforms[k] = _newNotValidPlatformInstallInfo(str(e))
+                self._dir = kwargs["dir"]
+                self._bootDir = os.path.join(self._dir, "boot")
+                # fs_uuid is the ISO volume uuid, grub-mkrescue uses the volume modification date, in the form of "YYYY-MM-DD-HH-MM-SS-00"
+                self._mnt = GrubStaticMountPoint(self._dir, kwargs.get("fs_uuid", None), "iso9660", None, "", "", True)
             else:
                 assert False
 
+            # fill self._platforms, detailed information of each platform is filled when it is first needed
+            self._platforms = dict()
+            self._unfilledPlatforms = set()
+            self._fillLock = threading.Lock()               # platform install info is filled lazily, maybe by several threads
+            if self._mode in [TargetAccessMode.R, TargetAccessMode.RW]:
+                if self._targetType in [TargetType.MOUNTED_HDD_DEV, TargetType.DISK_IMAGE_FILE]:
+                    _Common.init_platforms(self)
+                elif self._targetType == TargetType.PYCDLIB_OBJ:
+                    _PyCdLib.init_platforms(self)
+                elif self._targetType == TargetType.ISO_DIR:
+                    _Common.init_platforms(self)
+                else:
+                    assert False
+                self._unfilledPlatforms = set(self._platforms.keys())
+
     @property
     def target_type(self):
         return self._targetType
@@ -116,64 +131,111 @@ class Target:
     def target_access_mode(self):
         return self._mode
 
+    @property
+    def core_image_cache(self):
+        return self._coreImageCache
+
+    @core_image_cache.setter
+    def core_image_cache(self, value):
+        assert value is None or isinstance(value, CoreImageCache)
+        self._coreImageCache = value
+
+    @property
+    def disk(self):
+        # the physical disk (PartiUtil.partiToDisk() of the mounted partition) or the disk image file, None if the target is not on a disk
+        if self._targetType in [TargetType.MOUNTED_HDD_DEV, TargetType.DISK_IMAGE_FILE]:
+            return self._mnt.disk
+        else:
+            return None
+
+    @property
+    def iso_dir(self):
+        # the directory of ISO_DIR target, None for other targets
+        if self._targetType == TargetType.ISO_DIR:
+            return self._dir
+        else:
+            return None
+
+    @property
+    def tmp_work_dir(self):
+        return self._tmpDir
+
     @property
     def platforms(self):
+        for k in list(self._unfilledPlatforms):
+            self._fillPlatformInstallInfo(k)
         return [k for k, v in self._platforms.items() if v.status == PlatformInstallInfo.Status.NORMAL]
 
     def get_platform_install_info(self, platform_type):
         assert isinstance(platform_type, PlatformType)
 
         if platform_type in self._platforms:
+            if platform_type in self._unfilledPlatforms:
+                self._fillPlatformInstallInfo(platform_type)
             return self._platforms[platform_type]
         else:
             return _newNotInstalledPlatformInstallInfo()
 
+    def get_core_image_args(self, platform_type):
+        # returns (mkimage_target, module_list, fs_uuid, hints, prefix) for Grub.makeCoreImage(), None if the core image of the platform can't be made
+        # grub-probe may be run for MOUNTED_HDD_DEV target
+        assert isinstance(platform_type, PlatformType)
+
+        if self._mnt.fs_uuid is None:
+            return None
+        return _Common.get_core_image_args(self, platform_type)
+
     def install_platform(self, platform_type, source, **kwargs):
         assert self._mode in [TargetAccessMode.RW, TargetAccessMode.W]
         assert isinstance(platform_type, PlatformType)
         assert isinstance(source, Source)
 
-        ret = PlatformInstallInfo()
-        ret.status = PlatformInstallInfo.Status.NORMAL
+        with trace_span("install_platform", self._tracer, platform=platform_type.value):
+            self._installPlatformFiles(platform_type, source, kwargs)
+            self._platforms[platform_type] = self._installPlatformBootCode(platform_type, source, kwargs)
+            self._unfilledPlatforms.discard(platform_type)
+            self._trackPlatformWrites([platform_type])
+            self._commitWrites([])
+
+    def install_platforms(self, platform_types, source, locales=None, fonts=None, themes=None, max_workers=None, **kwargs):
+        # platform_types is a list of PlatformType, or a dict of PlatformType -> keyword arguments of install_platform() for that platform
+        # kwargs are keyword arguments of install_platform() for all the platforms
+        # module copies, core image builds and data file copies run concurrently, boot code (MBR, EFI files) are installed afterwards
+        assert self._mode in [TargetAccessMode.RW, TargetAccessMode.W]
+        assert all([isinstance(x, PlatformType) for x in platform_types])
+        assert isinstance(source, Source)
+        if locales is not None:
+            assert source.supports(source.CAP_NLS)
+        if fonts is not None:
+            assert source.supports(source.CAP_FONTS)
+        if themes is not None:
+            assert source.supports(source.CAP_THEMES)
 
-        if self._targetType == TargetType.MOUNTED_HDD_DEV:
-            _Common.install_platform(self, platform_type, source,
-                                     tmpDir=self._tmpDir,
-                                     debugImage=kwargs.get("debug_image", None))
-            if platform_type == PlatformType.I386_PC:
-                _Bios.install_with_mbr(platform_type, ret, source, self._bootDir, self._mnt.disk,
-                                       False,                                                           # bFloppyOrHdd
-                                       kwargs.get("allow_floppy", False),                               # bAllowFloppy
-                                       kwargs.get("bpb", True),                                         # bBpb
-                                       kwargs.get("rs_codes", True))                                    # bAddRsCodes
-            elif Handy.isPlatformEfi(platform_type):
-                _Efi.install_info_efi_dir(platform_type, ret, self._mnt.mountpoint, self._bootDir,
-                                          kwargs.get("use_rootfs_as_esp", False),                       # bUseRootfsAsEsp
-                                          kwargs.get("removable", False),                               # bRemovable
-                                          kwargs.get("update_nvram", True))                             # bUpdateNvram
+        with trace_span("install_platforms", self._tracer):
+            if isinstance(platform_types, dict):
+                kwargsDict = {pt: dict(kwargs, **platform_types[pt]) for pt in platform_types}
             else:
-                assert False
-        elif self._targetType == TargetType.PYCDLIB_OBJ:
-            # FIXME
-            assert False
-        elif self._targetType == TargetType.ISO_DIR:
-            _Common.install_platform(self, platform_type, source,
-                                     tmpDir=self._tmpDir,
-                                     debugImage=kwargs.get("debug_image", None))
-            if platform_type == PlatformType.I386_PC:
-                _Bios.install_without_mbr(platform_type, ret, source, self._bootDir)
-            elif Handy.isPlatformEfi(platform_type):
-                _Efi.install_info_efi_dir(platform_type, ret, self._dir, self._bootDir,
-                                          kwargs.get("removable", False),                               # bRemovable
-                                          False)                                                        # bUpdateNvram
+                kwargsDict = {pt: kwargs for pt in platform_types}
+
+            if self._targetType == TargetType.PYCDLIB_OBJ:
+                self._isoFs.makedirs(os.path.join(self._bootDir, "grub"))
             else:
-                assert False
-        else:
-            assert False
+                force_mkdir(os.path.join(self._bootDir, "grub"))
 
-        self._platforms[platform_type] = ret
+            funcList = [functools.partial(self._installPlatformFiles, pt, source, kwargsDict[pt]) for pt in kwargsDict]
+            if locales is not None or fonts is not None or themes is not None:
+                funcList.append(functools.partial(self._installDataFiles, source, locales, fonts, themes))
+            run_in_parallel(funcList, max_workers)
 
-    def remove_platform(self, platform_type):
+            # the MBR is read and written only once, by the only platform that uses it
+            for pt in kwargsDict:
+                self._platforms[pt] = self._installPlatformBootCode(pt, source, kwargsDict[pt])
+                self._unfilledPlatforms.discard(pt)
+
+            self._trackPlatformWrites(list(kwargsDict.keys()))
+            self._commitWrites([os.path.join(self._bootDir, "grub")])
+
+    def remove_platform(self, platform_type, **kwargs):
         assert self._mode in [TargetAccessMode.RW, TargetAccessMode.W]
         assert isinstance(platform_type, PlatformType)
 
@@ -181,31 +243,10 @@ class Target:
         if platform_type not in self._platforms:
             return
 
-        # do remove
-        if self._targetType == TargetType.MOUNTED_HDD_DEV:
-            if platform_type == PlatformType.I386_PC:
-                _Bios.remove_from_mbr(platform_type, self._mnt.disk)
-            elif Handy.isPlatformEfi(platform_type):
-                _Efi.remove_from_efi_dir(platform_type, self._mnt.mountpoint, self._bootDir)
-            else:
-                assert False
-            _Common.remove_platform(self, platform_type)
-        elif self._targetType == TargetType.PYCDLIB_OBJ:
-            # FIXME
-            assert False
-        elif self._targetType == TargetType.ISO_DIR:
-            if platform_type == PlatformType.I386_PC:
-                pass
-            elif Handy.isPlatformEfi(platform_type):
-                _Efi.remove_from_efi_dir(platform_type, self._dir, self._bootDir)
-            else:
-                assert False
-            _Common.remove_platform(self, platform_type)
-        else:
-            assert False
-
-        # delete PlatformInstallInfo object
-        del self._platforms[platform_type]
+        with trace_span("remove_platform", self._tracer, platform=platform_type.value):
+            self._removePlatform(platform_type, kwargs.get("direct_io", False))
+            self._trackPlatformWrites([platform_type])
+            self._commitWrites([])
 
     def install_data_files(self, source, locales=None, fonts=None, themes=None):
         assert self._mode in [TargetAccessMode.RW, TargetAccessMode.W]
@@ -216,72 +257,76 @@ class Target:
         if themes is not None:
             assert source.supports(source.CAP_THEMES)
 
-        grubDir = os.path.join(self._bootDir, "grub")
-        force_mkdir(grubDir)
-
-        if locales is not None:
-            dstDir = os.path.join(grubDir, "locale")
-            force_mkdir(dstDir, clear=True)
-            if locales == "*":
-                for lname, fullfn in source.get_all_locale_files().items():
-                    shutil.copy(fullfn, os.path.join(dstDir, "%s.mo" % (lname)))
-            else:
-                for lname in locales:
-                    shutil.copy(source.get_locale_file(lname), "%s.mo" % (lname))
-
-        if fonts is not None:
-            dstDir = os.path.join(grubDir, "fonts")
-            force_mkdir(dstDir, clear=True)
-            if fonts == "*":
-                for fname, fullfn in source.get_all_font_files().items():
-                    shutil.copy(fullfn, dstDir)
-            else:
-                for fname in fonts:
-                    shutil.copy(source.get_font_file(fname), dstDir)
-
-        if themes is not None:
-            dstDir = os.path.join(grubDir, "themes")
-            force_mkdir(dstDir, clear=True)
-            if themes == "*":
-                for tname, fullfn in source.get_all_theme_directories():
-                    shutil.copytree(fullfn, dstDir)
-            else:
-                for tname in themes:
-                    shutil.copytree(source.get_theme_directory(tname), dstDir)
+        with trace_span("install_data_files", self._tracer):
+            self._installDataFiles(source, locales, fonts, themes)
+            self._commitWrites([os.path.join(self._bootDir, "grub")])
 
     def remove_data_files(self):
         assert self._mode in [TargetAccessMode.RW, TargetAccessMode.W]
 
-        grubDir = os.path.join(self._bootDir, "grub")
-        force_rm(os.path.join(grubDir, "locale"))
-        force_rm(os.path.join(grubDir, "fonts"))
-        force_rm(os.path.join(grubDir, "themes"))
+        with trace_span("remove_data_files", self._tracer):
+            grubDir = os.path.join(self._bootDir, "grub")
+            if self._targetType == TargetType.PYCDLIB_OBJ:
+                _PyCdLib.remove_data_files(self)
+            else:
+                force_rm(os.path.join(grubDir, "locale"))
+                force_rm(os.path.join(grubDir, "fonts"))
+                force_rm(os.path.join(grubDir, "themes"))
+            self._commitWrites([grubDir])
 
     def remove_all(self):
         assert self._mode in [TargetAccessMode.RW, TargetAccessMode.W]
 
-        # remove platforms, some platform needs special processing
-        for k in list(self._platforms.keys()):
-            self.remove_platform(k)
+        with trace_span("remove_all", self._tracer):
+            # remove platforms, some platform needs special processing
+            platformTypeList = list(self._platforms.keys())
+            for k in platformTypeList:
+                self._removePlatform(k, False)
 
-        # remove remaining files
+            # remove remaining files
+            if self._targetType in [TargetType.MOUNTED_HDD_DEV, TargetType.DISK_IMAGE_FILE]:
+                _Efi.remove_remaining_crufts(self._mnt.mountpoint, self._bootDir)
+            elif self._targetType == TargetType.PYCDLIB_OBJ:
+                _PyCdLib.remove_remaining_crufts(self)
+            elif self._targetType == TargetType.ISO_DIR:
+                _Efi.remove_remaining_crufts(self._dir, self._bootDir)
+            else:
+                assert False
+            if self._targetType != TargetType.PYCDLIB_OBJ:
+                _Common.remove_remaining_crufts(self)
+
+            self._trackPlatformWrites(platformTypeList)
+            self._commitWrites([self._bootDir])
+
+    def invalidate_cache(self):
+        # drop cached partition table information and grub-probe result, call it after the disk is changed by others
+        self._diskInfoCache.invalidate()
         if self._targetType == TargetType.MOUNTED_HDD_DEV:
-            _Efi.remove_remaining_crufts(self._mnt.mountpoint, self._bootDir)
+            GrubMountPoint.invalidate_cache(self._mnt.device)
         elif self._targetType == TargetType.PYCDLIB_OBJ:
-            # FIXME
-            assert False
-        elif self._targetType == TargetType.ISO_DIR:
-            _Efi.remove_remaining_crufts(self._dir, self._bootDir)
-        else:
-            assert False
-        _Common.remove_remaining_crufts(self)
-
-    def compare_with_source(self, source):
+            self._isoFs.invalidate_cache()
+
+    def write_iso(self, fp):
+        # write the ISO of PYCDLIB_OBJ target into a seekable binary file object, it should be used instead of pycdlib's write_fp()
+        # boot records that pycdlib doesn't support (hybrid MBR of i386-pc) are patched in after pycdlib has written the ISO
+        assert self._targetType == TargetType.PYCDLIB_OBJ
+        assert self._mode == TargetAccessMode.W
+
+        with trace_span("write_iso", self._tracer):
+            start = fp.tell()
+            self._iso.write_fp(fp)
+            end = fp.tell()
+            for offset, buf in _PyCdLib.get_hybrid_patches(self, end - start):
+                fp.seek(start + offset)
+                fp.write(buf)
+            fp.seek(end)
+
+    def compare_with_source(self, source, max_workers=None):
         assert self._mode in [TargetAccessMode.R, TargetAccessMode.RW]
         assert isinstance(source, Source)
 
-        for pt in self._platforms:
-            if self._targetType == TargetType.MOUNTED_HDD_DEV:
+        def __checkPlatform(pt):
+            if self._targetType in [TargetType.MOUNTED_HDD_DEV, TargetType.DISK_IMAGE_FILE]:
                 restFiles = _Common.check_platform(self, pt, source, tmpDir=self._tmpDir)
                 if pt == PlatformType.I386_PC:
                     _Bios.check_rest_files(pt, source, self._bootDir, restFiles)
@@ -290,11 +335,17 @@ class Target:
                 else:
                     assert False
             elif self._targetType == TargetType.PYCDLIB_OBJ:
-                # FIXME
-                assert False
+                restFiles = _PyCdLib.check_platform(self, pt, source, tmpDir=self._tmpDir)
+                if pt == PlatformType.I386_PC:
+                    _PyCdLib.check_rest_files_bios(self, pt, source, restFiles)
+                elif Handy.isPlatformEfi(pt):
+                    pass
+                else:
+                    assert False
             elif self._targetType == TargetType.ISO_DIR:
                 restFiles = _Common.check_platform(self, pt, source, tmpDir=self._tmpDir)
                 if pt == PlatformType.I386_PC:
+                    _Common.check_eltorito_image(self, source, restFiles, tmpDir=self._tmpDir)
                     _Bios.check_rest_files(pt, source, self._bootDir, restFiles)
                 elif Handy.isPlatformEfi(pt):
                     pass
@@ -303,7 +354,201 @@ class Target:
             else:
                 assert False
 
-        _Common.check_data(self, source)
+        with trace_span("compare_with_source", self._tracer):
+            # all the checks are independent, the error of the first failed check (in list order) is raised
+            funcList = [functools.partial(__checkPlatform, pt) for pt in self._platforms]
+            if self._targetType == TargetType.PYCDLIB_OBJ:
+                funcList += _PyCdLib.prepare_check_data(self, source)
+            else:
+                funcList += _Common.prepare_check_data(self, source)
+            run_in_parallel(funcList, max_workers)
+
+    def _fillPlatformInstallInfo(self, platform_type):
+        with self._fillLock, trace_span("fill_platform_install_info", self._tracer, platform=platform_type.value):
+            if platform_type not in self._unfilledPlatforms:
+                return
+            k, v = platform_type, self._platforms[platform_type]
+            try:
+                if self._targetType in [TargetType.MOUNTED_HDD_DEV, TargetType.DISK_IMAGE_FILE]:
+                    if k == PlatformType.I386_PC:
+                        _Bios.fill_platform_install_info_with_mbr(k, v, self._bootDir, self._mnt.disk, self._diskOffset, self._diskInfoCache)
+                    elif Handy.isPlatformEfi(k):
+                        _Efi.fill_platform_install_info(k, v, self._targetType, self._mnt.mountpoint, self._bootDir)
+                    else:
+                        assert False
+                elif self._targetType == TargetType.PYCDLIB_OBJ:
+                    if k == PlatformType.I386_PC:
+                        _PyCdLib.fill_platform_install_info_bios(self, k, v)
+                    elif Handy.isPlatformEfi(k):
+                        _PyCdLib.fill_platform_install_info_efi(self, k, v)
+                    else:
+                        assert False
+                elif self._targetType == TargetType.ISO_DIR:
+                    if k == PlatformType.I386_PC:
+                        _Bios.fill_platform_install_info_without_mbr(k, v, self._bootDir)
+                    elif Handy.isPlatformEfi(k):
+                        _Efi.fill_platform_install_info(k, v, self._targetType, self._dir, self._bootDir)
+                    else:
+                        assert False
+                else:
+                    assert False
+            except TargetError as e:
+                self._platforms[k] = _newNotValidPlatformInstallInfo(str(e))
+            self._unfilledPlatforms.discard(k)
+
+    def _installPlatformFiles(self, platform_type, source, kwargs):
+        with trace_span("install_files", platform=platform_type.value):
+            # El Torito image is made for i386-pc on ISO targets
+            bEltorito = (self._targetType in [TargetType.ISO_DIR, TargetType.PYCDLIB_OBJ] and platform_type == PlatformType.I386_PC and kwargs.get("eltorito", True))
+            if self._targetType in [TargetType.MOUNTED_HDD_DEV, TargetType.ISO_DIR, TargetType.DISK_IMAGE_FILE]:
+                _Common.install_platform(self, platform_type, source,
+                                         tmpDir=self._tmpDir,
+                                         debugImage=kwargs.get("debug_image", None),
+                                         modules=kwargs.get("modules", "*"),
+                                         bEltorito=bEltorito)
+            elif self._targetType == TargetType.PYCDLIB_OBJ:
+                _PyCdLib.install_platform(self, platform_type, source,
+                                          tmpDir=self._tmpDir,
+                                          debugImage=kwargs.get("debug_image", None),
+                                          modules=kwargs.get("modules", "*"),
+                                          bEltorito=bEltorito)
+            else:
+                assert False
+
+    def _installPlatformBootCode(self, platform_type, source, kwargs):
+        with trace_span("install_boot_code", platform=platform_type.value):
+            ret = PlatformInstallInfo()
+            ret.status = PlatformInstallInfo.Status.NORMAL
+
+            if self._targetType in [TargetType.MOUNTED_HDD_DEV, TargetType.DISK_IMAGE_FILE]:
+                if platform_type == PlatformType.I386_PC:
+                    _Bios.install_with_mbr(platform_type, ret, source, self._bootDir, self._mnt.disk, self._diskOffset, self._diskInfoCache,
+                                           False,                                                           # bFloppyOrHdd
+                                           kwargs.get("allow_floppy", False),                               # bAllowFloppy
+                                           kwargs.get("bpb", True),                                         # bBpb
+                                           kwargs.get("rs_codes", True),                                    # bAddRsCodes
+                                           kwargs.get("direct_io", False))                                  # bDirectIo
+                elif Handy.isPlatformEfi(platform_type):
+                    _Efi.install_info_efi_dir(platform_type, ret, self._mnt.mountpoint, self._bootDir,
+                                              kwargs.get("use_rootfs_as_esp", False),                       # bUseRootfsAsEsp
+                                              kwargs.get("removable", False),                               # bRemovable
+                                              kwargs.get("update_nvram", True))                             # bUpdateNvram
+                else:
+                    assert False
+            elif self._targetType == TargetType.PYCDLIB_OBJ:
+                if platform_type == PlatformType.I386_PC:
+                    _PyCdLib.install_bios(self, platform_type, ret, source,
+                                          kwargs.get("eltorito", True),                                     # bEltorito
+                                          kwargs.get("hybrid_mbr", True))                                   # bHybridMbr
+                elif Handy.isPlatformEfi(platform_type):
+                    _PyCdLib.install_efi(self, platform_type, ret,
+                                         kwargs.get("removable", False))                                   # bRemovable
+                else:
+                    assert False
+            elif self._targetType == TargetType.ISO_DIR:
+                if platform_type == PlatformType.I386_PC:
+                    _Bios.install_without_mbr(platform_type, ret, source, self._bootDir,
+                                              kwargs.get("eltorito", True))                                 # bEltorito
+                elif Handy.isPlatformEfi(platform_type):
+                    _Efi.install_info_efi_dir(platform_type, ret, self._dir, self._bootDir,
+                                              True,                                                         # bUseRootfsAsEsp
+                                              kwargs.get("removable", False),                               # bRemovable
+                                              False)                                                        # bUpdateNvram
+                else:
+                    assert False
+            else:
+                assert False
+
+            return ret
+
+    def _installDataFiles(self, source, locales, fonts, themes):
+        with trace_span("install_data_files"):
+            if self._targetType == TargetType.PYCDLIB_OBJ:
+                _PyCdLib.install_data_files(self, source, locales, fonts, themes)
+                return
+
+            grubDir = os.path.join(self._bootDir, "grub")
+            force_mkdir(grubDir)
+
+            # files with the same content are not copied again, other files in the directories are removed
+            if locales is not None:
+                dstDir = os.path.join(grubDir, "locale")
+                force_mkdir(dstDir)
+                if locales == "*":
+                    pairList = [(fullfn, os.path.join(dstDir, "%s.mo" % (lname))) for lname, fullfn in source.get_all_locale_files().items()]
+                else:
+                    pairList = [(source.get_locale_file(lname), os.path.join(dstDir, "%s.mo" % (lname))) for lname in locales]
+                remove_redundant_entries(dstDir, set([os.path.basename(x[1]) for x in pairList]))
+                self._copyEngine.copy_files(pairList)
+
+            if fonts is not None:
+                dstDir = os.path.join(grubDir, "fonts")
+                force_mkdir(dstDir)
+                if fonts == "*":
+                    pairList = [(fullfn, os.path.join(dstDir, "%s.pf2" % (fname))) for fname, fullfn in source.get_all_font_files().items()]
+                else:
+                    pairList = [(source.get_font_file(fname), os.path.join(dstDir, "%s.pf2" % (fname))) for fname in fonts]
+                remove_redundant_entries(dstDir, set([os.path.basename(x[1]) for x in pairList]))
+                self._copyEngine.copy_files(pairList)
+
+            if themes is not None:
+                dstDir = os.path.join(grubDir, "themes")
+                force_mkdir(dstDir)
+                if themes == "*":
+                    themeDict = source.get_all_theme_directories()
+                else:
+                    themeDict = {tname: source.get_theme_directory(tname) for tname in themes}
+                remove_redundant_entries(dstDir, set(themeDict.keys()))
+                for tname, fullfn in themeDict.items():
+                    self._copyEngine.copy_tree(fullfn, os.path.join(dstDir, tname), mirror=True)
+
+    def _removePlatform(self, platform_type, bDirectIo):
+        if self._targetType in [TargetType.MOUNTED_HDD_DEV, TargetType.DISK_IMAGE_FILE]:
+            if platform_type == PlatformType.I386_PC:
+                _Bios.remove_from_mbr(platform_type, self._mnt.disk, self._diskOffset, self._diskInfoCache, bDirectIo)
+            elif Handy.isPlatformEfi(platform_type):
+                _Efi.remove_from_efi_dir(platform_type, self._mnt.mountpoint, self._bootDir)
+            else:
+                assert False
+            _Common.remove_platform(self, platform_type)
+        elif self._targetType == TargetType.PYCDLIB_OBJ:
+            _PyCdLib.remove_platform(self, platform_type)
+        elif self._targetType == TargetType.ISO_DIR:
+            if platform_type == PlatformType.I386_PC:
+                pass
+            elif Handy.isPlatformEfi(platform_type):
+                _Efi.remove_from_efi_dir(platform_type, self._dir, self._bootDir)
+            else:
+                assert False
+            _Common.remove_platform(self, platform_type)
+        else:
+            assert False
+
+        # delete PlatformInstallInfo object
+        del self._platforms[platform_type]
+        self._unfilledPlatforms.discard(platform_type)
+
+    def _trackPlatformWrites(self, platformTypeList):
+        if self._syncTracker is None:
+            return
+        for pt in platformTypeList:
+            self._syncTracker.add_path(os.path.join(self._bootDir, "grub", pt.value))
+            if pt == PlatformType.I386_PC:
+                if self._targetType in [TargetType.MOUNTED_HDD_DEV, TargetType.DISK_IMAGE_FILE]:
+                    self._syncTracker.add_device(self._mnt.disk)
+            elif Handy.isPlatformEfi(pt):
+                rootfsDir = self._dir if self._targetType == TargetType.ISO_DIR else self._mnt.mountpoint
+                self._syncTracker.add_path(os.path.join(rootfsDir, "EFI", "BOOT"))
+                self._syncTracker.add_path(os.path.join(self._bootDir, "EFI", "BOOT"))
+
+    def _commitWrites(self, pathList):
+        # files and directories written by this operation are flushed with one syncfs() per filesystem, MBR with one fdatasync()
+        if self._syncTracker is None:
+            return
+        for path in pathList:
+            self._syncTracker.add_path(path)
+        with trace_span("sync"):
+            self._syncTracker.commit()
 
 
 class _Common:
@@ -321,49 +566,119 @@ class _Common:
                     pass
 
     @staticmethod
-    def install_platform(p, platform_type, source, tmpDir=None, debugImage=None):
+    def install_platform(p, platform_type, source, tmpDir=None, debugImage=None, modules="*", bEltorito=False):
         grubDir = os.path.join(p._bootDir, "grub")
-        platDirSrc = source.get_platform_directory(platform_type)
         platDirDst = os.path.join(grubDir, platform_type.value)
+        fileList = _Common.get_platform_files_to_install(p, platform_type, source, modules)
+        modListContent = _Common.get_module_list_file_content(modules)
+
+        # install module files
+        if True:
+            force_mkdir(grubDir)
+            force_mkdir(platDirDst)
+
+            # FIXME: specify owner, group, mode?
+            # files with the same content are not copied again, other files in the directory are removed
+            with trace_span("copy_modules"):
+                keepNameSet = set([os.path.basename(x) for x in fileList])
+                if modListContent is not None:
+                    keepNameSet.add(Grub.MODULE_LIST_FILE_NAME)
+                remove_redundant_entries(platDirDst, keepNameSet)
+                p._copyEngine.copy_files([(x, os.path.join(platDirDst, os.path.basename(x))) for x in fileList])
+
+            # record the install mode
+            if modListContent is not None:
+                with open(os.path.join(platDirDst, Grub.MODULE_LIST_FILE_NAME), "w") as f:
+                    f.write(modListContent)
+
+        # make core.img
+        coreName = Grub.getCoreImgNameAndTarget(platform_type)[0]
+        coreBuf = Grub.makeCoreImage(source, platform_type, *_Common.get_core_image_args(p, platform_type), debugImage, tmpDir=tmpDir, cache=p._coreImageCache)
+        with open(os.path.join(platDirDst, coreName), "wb") as f:
+            f.write(coreBuf)
+
+        # make eltorito.img
+        if bEltorito:
+            with open(os.path.join(platDirDst, Grub.ELTORITO_IMG_NAME), "wb") as f:
+                f.write(_Common.make_eltorito_image(p, source, debugImage, tmpDir=tmpDir))
+
+    @staticmethod
+    def get_platform_files_to_install(p, platform_type, source, modules="*"):
+        # returns the list of files in the platform directory of source that should be installed
+        platDirSrc = source.get_platform_directory(platform_type)
 
         if p._mnt.fs_uuid is None:
             raise InstallError("no fsuuid found")
-        if Handy.isPlatformEfi(platform_type) and (not p._mnt.is_boot_mount_point() or p._mnt.grub_fs != "fat"):
+        if p._targetType in [TargetType.MOUNTED_HDD_DEV, TargetType.DISK_IMAGE_FILE] and Handy.isPlatformEfi(platform_type) and (not p._mnt.is_boot_mount_point() or p._mnt.grub_fs != "fat"):
             raise InstallError("%s doesn't look like an EFI partition" % (p._bootDir))
 
-        # get module list and hints
-        moduleList, hints = Grub.getModuleListAndHnits(platform_type, p._mnt)
-
-        # install module files
-        # FIXME: install only required modules
-        if True:
-            force_mkdir(grubDir)
-            force_mkdir(platDirDst, clear=True)
+        # get module list
+        moduleList = Grub.getModuleListAndHnits(platform_type, p._mnt)[0]
 
-            def __copy(fullfn, dstDir):
-                # FIXME: specify owner, group, mode?
-                shutil.copy(fullfn, platDirDst)
+        # get module files to install
+        if modules == "*":
+            modFileList = [os.path.join(platDirSrc, x) for x in source.get_platform_files(platform_type) if x.endswith(".mod")]
+        else:
+            # install only the dependency closure of the modules needed by core.img, the runtime modules and the user specified modules
+            # module index of source is loaded by the first call, which raises SourceError if the module lists are missing or invalid
+            try:
+                if source.try_get_fs_module(platform_type, p._mnt.grub_fs) is None:
+                    raise InstallError("filesystem module %s is not in fs.lst" % (p._mnt.grub_fs))
+                if p._mnt.grub_partmap is not None and source.try_get_partmap_module(platform_type, p._mnt.grub_partmap) is None:
+                    raise InstallError("partition map module part_%s is not in partmap.lst" % (p._mnt.grub_partmap))
+                modNameSet = source.get_module_dependency_closure(platform_type, moduleList + Grub.PLATFORM_RUNTIME_MODULES + list(modules))
+            except SourceError as e:
+                raise InstallError(str(e))
+            modFileList = [os.path.join(platDirSrc, x + ".mod") for x in sorted(modNameSet)]
+
+        ret = list(modFileList)
+        ret += [os.path.join(platDirSrc, fn) for fn in Grub.PLATFORM_ADDON_FILES]
+        ret += [os.path.join(platDirSrc, fn) for fn in Grub.PLATFORM_OPTIONAL_ADDON_FILES if fn in source.get_platform_files(platform_type)]
+        return ret
 
-            # copy module files
-            for fullfn in glob.glob(os.path.join(platDirSrc, "*.mod")):
-                __copy(fullfn, platDirDst)
+    @staticmethod
+    def get_module_list_file_content(modules):
+        # returns the content of Grub.MODULE_LIST_FILE_NAME, None if all the modules are installed
+        if modules == "*":
+            return None
+        return "".join([x + "\n" for x in sorted(set(modules))])
 
-            # copy other files
-            for fn in Grub.PLATFORM_ADDON_FILES:
-                __copy(os.path.join(platDirSrc, fn), platDirDst)
+    @staticmethod
+    def get_core_image_args(p, platform_type):
+        # returns (mkimage_target, module_list, rootFsUuid, rootHints, prefixDir) for Grub.makeCoreImage()
+        moduleList, hints = Grub.getModuleListAndHnits(platform_type, p._mnt)
+        mkimageTarget = Grub.getCoreImgNameAndTarget(platform_type)[1]
+        return (mkimageTarget, moduleList, p._mnt.fs_uuid, hints, rel_path(p._mnt.mountpoint, os.path.join(p._bootDir, "grub")))
 
-            # copy optional files
-            for fn in Grub.PLATFORM_OPTIONAL_ADDON_FILES:
-                fullfn = os.path.join(platDirSrc, fn)
-                if os.path.exists(fullfn):
-                    __copy(fullfn, platDirDst)
+    @staticmethod
+    def make_eltorito_image(p, source, debugImage, tmpDir=None):
+        # El Torito image is the core.img for booting from iso9660 by BIOS, same as grub-mkrescue
+        mkimageTarget, moduleList, fsUuid, hints, prefixDir = _Common.get_core_image_args(p, PlatformType.I386_PC)
+        moduleList = moduleList + [x for x in ["biosdisk", "iso9660"] if x not in moduleList]
+        return Grub.makeCoreImage(source, PlatformType.I386_PC, Grub.ELTORITO_MKIMAGE_TARGET, moduleList, fsUuid, hints, prefixDir, debugImage, tmpDir=tmpDir, cache=p._coreImageCache)
 
-        # make core.img
-        coreName, mkimageTarget = Grub.getCoreImgNameAndTarget(platform_type)
-        coreBuf = Grub.makeCoreImage(source, platform_type, mkimageTarget, moduleList, p._mnt.fs_uuid,
-                                     hints, rel_path(p._mnt.mountpoint, grubDir), debugImage, tmpDir=tmpDir)
-        with open(os.path.join(platDirDst, coreName), "wb") as f:
-            f.write(coreBuf)
+    @staticmethod
+    def check_eltorito_image(p, source, rest_files, tmpDir=None, readFunc=None):
+        # eltorito.img is optional, it's removed from rest_files if it is same as the generated El Torito image
+        fullfn = os.path.join(p._bootDir, "grub", PlatformType.I386_PC.value, Grub.ELTORITO_IMG_NAME)
+        key = fullfn if readFunc is None else Grub.ELTORITO_IMG_NAME
+        if key not in rest_files:
+            return
+        rest_files.remove(key)
+
+        buf = pathlib.Path(fullfn).read_bytes() if readFunc is None else readFunc(fullfn)
+        for debugImage in [None, False, True]:
+            genBuf = _Common.make_eltorito_image(p, source, debugImage, tmpDir=tmpDir)
+            if len(genBuf) != len(buf):
+                continue
+
+            # the boot info table and the first blocklist entry of diskboot.img are patched when the ISO is written
+            tmpBuf = bytearray(buf)
+            for s, e in [(8, 64), (Grub.ELTORITO_GRUB2_BOOT_INFO, Grub.ELTORITO_GRUB2_BOOT_INFO + 8)]:
+                tmpBuf[s:e] = genBuf[s:e]
+            if tmpBuf == genBuf:
+                return
+        raise CompareWithSourceError("%s is different with the generated El Torito image" % (fullfn))
 
     @staticmethod
     def remove_platform(p, platform_type):
@@ -376,13 +691,21 @@ class _Common:
 
     @staticmethod
     def check_platform(p, platform_type, source, tmpDir=None):
-        grubDir = os.path.join(p._bootDir, "grub")
         platDirSrc = source.get_platform_directory(platform_type)
         platDirDst = os.path.join(p._bootDir, "grub", platform_type.value)
         assert os.path.exists(platDirDst)
 
         fileSet = set()
 
+        # get module files to check
+        modListFile = os.path.join(platDirDst, Grub.MODULE_LIST_FILE_NAME)
+        if os.path.exists(modListFile):
+            userModuleList = pathlib.Path(modListFile).read_text().split()
+            fileSet.add(modListFile)
+        else:
+            userModuleList = None
+        modNameSet = _Common.get_module_names_to_check(p, platform_type, source, [os.path.basename(x) for x in glob.glob(os.path.join(platDirDst, "*.mod"))], userModuleList)
+
         # check module files
         if True:
             def __check(fullfn, fullfn2):
@@ -394,8 +717,8 @@ class _Common:
                 fileSet.add(fullfn2)
 
             # check module files
-            for fullfn in glob.glob(os.path.join(platDirSrc, "*.mod")):
-                __check(fullfn, os.path.join(platDirDst, os.path.basename(fullfn)))
+            for name in sorted(modNameSet):
+                __check(os.path.join(platDirSrc, name + ".mod"), os.path.join(platDirDst, name + ".mod"))
 
             # check addon files
             for fn in Grub.PLATFORM_ADDON_FILES:
@@ -409,65 +732,93 @@ class _Common:
 
         # check core.img
         bSame = False
-        for debugImage in [False, True]:
-            moduleList, hints = Grub.getModuleListAndHnits(platform_type, p._mnt)
-            coreName, mkimageTarget = Grub.getCoreImgNameAndTarget(platform_type)
-            coreBuf = Grub.makeCoreImage(source, platform_type, mkimageTarget, moduleList, p._mnt.fs_uuid,
-                                         hints, rel_path(p._mnt.mountpoint, grubDir), debugImage, tmpDir=tmpDir)
-            coreImgPath = os.path.join(platDirDst, coreName)
-            if not compare_file_and_content(coreImgPath, coreBuf):
+        coreImgPath = os.path.join(platDirDst, Grub.getCoreImgNameAndTarget(platform_type)[0])
+        for debugImage in [None, False, True]:
+            coreBuf = Grub.makeCoreImage(source, platform_type, *_Common.get_core_image_args(p, platform_type), debugImage, tmpDir=tmpDir, cache=p._coreImageCache)
+            if compare_file_and_content(coreImgPath, coreBuf):
                 fileSet.add(coreImgPath)
                 bSame = True
                 break
         if not bSame:
-            raise CompareWithSourceError("%s and %s are different" % (fullfn, fullfn2))
+            raise CompareWithSourceError("%s is different with the generated core image" % (coreImgPath))
 
         # check redundant
         return set(glob.glob(os.path.join(platDirDst, "*"))) - fileSet
 
     @staticmethod
-    def check_data(p, source):
+    def get_module_names_to_check(p, platform_type, source, dstModFileList, userModuleList):
+        # userModuleList is the content of Grub.MODULE_LIST_FILE_NAME, None if all the modules should be installed
+        srcModNameSet = set([x[:-4] for x in source.get_platform_files(platform_type) if x.endswith(".mod")])
+        dstModNameSet = set([x[:-4] for x in dstModFileList])
+        if userModuleList is None:
+            modNameSet = srcModNameSet
+        else:
+            # only the dependency closure of the required modules is installed
+            moduleList = Grub.getModuleListAndHnits(platform_type, p._mnt)[0]
+            try:
+                modNameSet = source.get_module_dependency_closure(platform_type, moduleList + Grub.PLATFORM_RUNTIME_MODULES + userModuleList)
+            except SourceError as e:
+                raise CompareWithSourceError(str(e))
+        if not dstModNameSet.issubset(modNameSet):
+            raise CompareWithSourceError("redundant module %s found" % (sorted(dstModNameSet - modNameSet)[0]))
+        return modNameSet
+
+    @staticmethod
+    def prepare_check_data(p, source):
+        # returns a list of check functions, so that they can be run in parallel
+        # errors are raised by the functions too, so that they are reported in the same order as the other checks
+        ret = []
+
+        def __check(fullfn, fullfn2, compareFunc):
+            if not compareFunc(fullfn, fullfn2):
+                raise CompareWithSourceError("%s and %s are different" % (fullfn, fullfn2))
+
+        def __fail(msg):
+            raise CompareWithSourceError(msg)
+
         localeDir = os.path.join(p._bootDir, "grub", "locale")
         if os.path.exists(localeDir):
             if not source.supports(source.CAP_NLS):
-                raise CompareWithSourceError("NLS is not supported")
-            for fn2 in os.listdir(localeDir):
-                fullfn2 = os.path.join(localeDir, fn2)
-                if fn2.endswith(".mo"):
-                    lname = fn2.replace(".mo", "")
-                    fullfn = source.try_get_locale_file(lname)
-                    if fullfn is not None:
-                        if not compare_files(fullfn, fullfn2):
-                            raise CompareWithSourceError("%s and %s are different" % (fullfn, fullfn2))
-                        continue
-                raise CompareWithSourceError("redundant file %s found" % (fullfn2))
+                ret.append(functools.partial(__fail, "NLS is not supported"))
+            else:
+                for fn2 in sorted(os.listdir(localeDir)):
+                    fullfn2 = os.path.join(localeDir, fn2)
+                    if fn2.endswith(".mo"):
+                        lname = fn2.replace(".mo", "")
+                        fullfn = source.try_get_locale_file(lname)
+                        if fullfn is not None:
+                            ret.append(functools.partial(__check, fullfn, fullfn2, compare_files))
+                            continue
+                    ret.append(functools.partial(__fail, "redundant file %s found" % (fullfn2)))
 
         fontsDir = os.path.join(p._bootDir, "grub", "fonts")
         if os.path.exists(fontsDir):
             if not source.supports(source.CAP_FONTS):
-                raise CompareWithSourceError("fonts is not supported")
-            for fullfn2 in glob.glob(os.path.join(fontsDir, "*.pf2")):
-                fname = os.path.basename(fullfn2).replace(".pf2", "")
-                fullfn = source.try_get_font_file(fname)
-                if fullfn is not None:
-                    if not compare_files(fullfn, fullfn2):
-                        raise CompareWithSourceError("%s and %s are different" % (fullfn, fullfn2))
-                    continue
-                raise CompareWithSourceError("redundant file %s found" % (fullfn2))
+                ret.append(functools.partial(__fail, "fonts is not supported"))
+            else:
+                for fullfn2 in sorted(glob.glob(os.path.join(fontsDir, "*.pf2"))):
+                    fname = os.path.basename(fullfn2).replace(".pf2", "")
+                    fullfn = source.try_get_font_file(fname)
+                    if fullfn is not None:
+                        ret.append(functools.partial(__check, fullfn, fullfn2, compare_files))
+                        continue
+                    ret.append(functools.partial(__fail, "redundant file %s found" % (fullfn2)))
 
         themesDir = os.path.join(p._bootDir, "grub", "themes")
         if os.path.exists(themesDir):
             if not source.supports(source.CAP_THEMES):
-                raise CompareWithSourceError("themes is not supported")
-            for tname in os.listdir(themesDir):
-                fullfn2 = os.path.join(themesDir, tname)
-                if os.path.isdir(fullfn2):
-                    fullfn = source.try_get_theme_directory(tname)
-                    if fullfn is not None:
-                        if not compare_directories(fullfn, fullfn2):
-                            raise CompareWithSourceError("%s and %s are different" % (fullfn, fullfn2))
-                        continue
-                raise CompareWithSourceError("redundant file %s found" % (fullfn2))
+                ret.append(functools.partial(__fail, "themes is not supported"))
+            else:
+                for tname in sorted(os.listdir(themesDir)):
+                    fullfn2 = os.path.join(themesDir, tname)
+                    if os.path.isdir(fullfn2):
+                        fullfn = source.try_get_theme_directory(tname)
+                        if fullfn is not None:
+                            ret.append(functools.partial(__check, fullfn, fullfn2, compare_directories))
+                            continue
+                    ret.append(functools.partial(__fail, "redundant file %s found" % (fullfn2)))
+
+        return ret
 
 
 class _Bios:
@@ -481,18 +832,18 @@ class _Bios:
         platform_install_info.allow_floppy = True
         platform_install_info.bpb = True
         platform_install_info.rs_codes = True
+        platform_install_info.eltorito = os.path.exists(os.path.join(bootDir, "grub", platform_type.value, Grub.ELTORITO_IMG_NAME))
 
     @classmethod
-    def fill_platform_install_info_with_mbr(cls, platform_type, platform_install_info, bootDir, dev):
+    def fill_platform_install_info_with_mbr(cls, platform_type, platform_install_info, bootDir, dev, offset, diskInfoCache):
         bootBuf = bytearray(cls._checkAndReadBootImg(platform_type, bootDir, TargetError))     # bootBuf needs to be writable
         coreBuf = cls._checkAndReadCoreImg(platform_type, bootDir, TargetError)
 
-        # read MBR and MBR-gap
-        tmpBootBuf, tmpRestBuf = None, None
-        cls._checkDisk(dev, TargetError)
-        with open(dev, "rb") as f:
-            tmpBootBuf = f.read(len(bootBuf))
-            tmpRestBuf = f.read(cls._getCoreBufMaxSize() - len(bootBuf))
+        # read MBR and MBR-gap, tmpBootBuf and tmpRestBuf are memoryview slices of the snapshot
+        cls._checkDisk(dev, offset, diskInfoCache, TargetError)
+        snapshot = cls._readMbrAndMbrGap(dev, offset, False, TargetError)
+        tmpBootBuf = snapshot.view[:len(bootBuf)]
+        tmpRestBuf = snapshot.view[len(bootBuf):]
 
         # boot.img and core.img is not installed
         if tmpBootBuf == cls._getAllZeroBootBuf(tmpBootBuf) and is_buffer_all_zero(tmpRestBuf):
@@ -535,8 +886,9 @@ class _Bios:
                 raise TargetError("invalid on-disk core.img content")
 
         # compare rest bytes
-        if not is_buffer_all_zero(tmpRestBuf):
-            raise TargetError("disk content after core.img should be all zero")
+        i = find_first_non_zero_byte(tmpRestBuf[len(coreBuf):])
+        if i >= 0:
+            raise TargetError("disk content after core.img should be all zero, non-zero byte found at offset %u" % (len(bootBuf) + len(coreBuf) + i))
 
         # return
         platform_install_info.mbr_installed = True
@@ -545,7 +897,7 @@ class _Bios:
         platform_install_info.rs_codes = bRsCodes
 
     @classmethod
-    def install_without_mbr(cls, platform_type, platform_install_info, source, bootDir):
+    def install_without_mbr(cls, platform_type, platform_install_info, source, bootDir, bEltorito=False):
         # copy boot.img
         shutil.copy(os.path.join(source.get_platform_directory(platform_type), "boot.img"), os.path.join(bootDir, "grub", platform_type.value))
 
@@ -554,9 +906,10 @@ class _Bios:
         platform_install_info.allow_floppy = True
         platform_install_info.bpb = True
         platform_install_info.rs_codes = False
+        platform_install_info.eltorito = bEltorito
 
     @classmethod
-    def install_with_mbr(cls, platform_type, platform_install_info, source, bootDir, dev, bFloppyOrHdd, bAllowFloppy, bBpb, bAddRsCodes):
+    def install_with_mbr(cls, platform_type, platform_install_info, source, bootDir, dev, offset, diskInfoCache, bFloppyOrHdd, bAllowFloppy, bBpb, bAddRsCodes, bDirectIo=False):
         assert not bFloppyOrHdd and not bAllowFloppy        # FIXME
 
         # copy boot.img
@@ -564,41 +917,43 @@ class _Bios:
 
         bootBuf = bytearray(cls._checkAndReadBootImg(platform_type, bootDir, InstallError))     # bootBuf needs to be writable
         coreBuf = cls._checkAndReadCoreImg(platform_type, bootDir, InstallError)
-        cls._checkDisk(dev, InstallError)
-
-        with open(dev, "rb+") as f:
-            tmpBootBuf = f.read(len(bootBuf))
-
-            # prepare bootBuf
-            if True:
-                # Copy the possible DOS BPB.
-                if bBpb:
-                    s, e = Grub.BOOT_MACHINE_BPB_START, Grub.BOOT_MACHINE_BPB_END
-                    bootBuf[s:e] = tmpBootBuf[s:e]
-
-                # If DEST_DRIVE is a hard disk, enable the workaround, which is
-                # for buggy BIOSes which don't pass boot drive correctly. Instead,
-                # they pass 0x00 or 0x01 even when booted from 0x80.
-                if not bAllowFloppy and not bFloppyOrHdd:
-                    # Replace the jmp (2 bytes) with double nop's.
-                    s, e = Grub.BOOT_MACHINE_DRIVE_CHECK, Grub.BOOT_MACHINE_DRIVE_CHECK + 2
-                    bootBuf[s:e] == b'\x90\x90'
-
-                # Copy the partition table.
-                if not bAllowFloppy and not bFloppyOrHdd:
-                    s, e = Grub.BOOT_MACHINE_WINDOWS_NT_MAGIC, Grub.BOOT_MACHINE_PART_END
-                    bootBuf[s:e] = tmpBootBuf[s:e]
-
-            # prepare coreBuf
-            if bAddRsCodes:
-                coreBuf = cls._getRsEncodedCoreBuf(coreBuf, Handy.isPlatformBigEndianOrLittleEndian(platform_type))
-
-            # write up to cls._getCoreImgMaxSize()
-            f.seek(0)
-            f.write(bootBuf)
-            f.write(coreBuf)
-            for i in range(0, cls._getCoreBufMaxSize() - len(coreBuf) - len(bootBuf)):
-                f.write(b'\x00')
+        cls._checkDisk(dev, offset, diskInfoCache, InstallError)
+
+        # read MBR and MBR-gap
+        snapshot = cls._readMbrAndMbrGap(dev, offset, bDirectIo, InstallError)
+        tmpBootBuf = snapshot.view[:len(bootBuf)]
+
+        # prepare bootBuf
+        if True:
+            # Copy the possible DOS BPB.
+            if bBpb:
+                s, e = Grub.BOOT_MACHINE_BPB_START, Grub.BOOT_MACHINE_BPB_END
+                bootBuf[s:e] = tmpBootBuf[s:e]
+
+            # If DEST_DRIVE is a hard disk, enable the workaround, which is
+            # for buggy BIOSes which don't pass boot drive correctly. Instead,
+            # they pass 0x00 or 0x01 even when booted from 0x80.
+            if not bAllowFloppy and not bFloppyOrHdd:
+                # Replace the jmp (2 bytes) with double nop's.
+                s, e = Grub.BOOT_MACHINE_DRIVE_CHECK, Grub.BOOT_MACHINE_DRIVE_CHECK + 2
+                bootBuf[s:e] = b'\x90\x90'
+
+            # Copy the partition table.
+            if not bAllowFloppy and not bFloppyOrHdd:
+                s, e = Grub.BOOT_MACHINE_WINDOWS_NT_MAGIC, Grub.BOOT_MACHINE_PART_END
+                bootBuf[s:e] = tmpBootBuf[s:e]
+
+        # prepare coreBuf
+        if bAddRsCodes:
+            coreBuf = cls._getRsEncodedCoreBuf(coreBuf, Handy.isPlatformBigEndianOrLittleEndian(platform_type))
+
+        # write up to cls._getCoreImgMaxSize(), unchanged sectors are skipped
+        buf = bytearray(cls._getCoreBufMaxSize())
+        buf[:len(bootBuf)] = bootBuf
+        buf[len(bootBuf):len(bootBuf) + len(coreBuf)] = coreBuf
+        with trace_span("write_mbr"):
+            if snapshot.write_if_different(buf, Grub.DISK_SECTOR_SIZE, bDirectIo) > 0:
+                diskInfoCache.invalidate()
 
         # fill custom attributes
         platform_install_info.mbr_installed = True
@@ -607,19 +962,18 @@ class _Bios:
         platform_install_info.rs_codes = bAddRsCodes
 
     @classmethod
-    def remove_from_mbr(cls, platform_type, dev):
-        cls._checkDisk(dev, None)
+    def remove_from_mbr(cls, platform_type, dev, offset, diskInfoCache, bDirectIo=False):
+        cls._checkDisk(dev, offset, diskInfoCache, None)
 
-        with open(dev, "rb+") as f:
-            # prepare allZeroBootBuf
-            tmpBootBuf = f.read(Grub.DISK_SECTOR_SIZE)
-            allZeroBootBuf = cls._getAllZeroBootBuf(tmpBootBuf)
+        # read MBR and MBR-gap
+        snapshot = cls._readMbrAndMbrGap(dev, offset, bDirectIo, None)
 
-            # write up to cls._getCoreImgMaxSize()
-            f.seek(0)
-            f.write(allZeroBootBuf)
-            for i in range(0, cls._getCoreBufMaxSize() - len(allZeroBootBuf)):
-                f.write(b'\x00')
+        # write up to cls._getCoreImgMaxSize(), unchanged sectors are skipped
+        buf = bytearray(cls._getCoreBufMaxSize())
+        buf[:Grub.DISK_SECTOR_SIZE] = cls._getAllZeroBootBuf(snapshot.view[:Grub.DISK_SECTOR_SIZE])
+        with trace_span("write_mbr"):
+            if snapshot.write_if_different(buf, Grub.DISK_SECTOR_SIZE, bDirectIo) > 0:
+                diskInfoCache.invalidate()
 
     @staticmethod
     def check_rest_files(platform_type, source, bootDir, rest_files):
@@ -636,7 +990,7 @@ class _Bios:
             raise CompareWithSourceError("%s does not exist" % (dstFile))
 
         if len(rest_files) > 0:
-            raise CompareWithSourceError("redundant file %s found" % (rest_files[0]))
+            raise CompareWithSourceError("redundant file %s found" % (sorted(rest_files)[0]))
 
     @staticmethod
     def _getCoreBufMaxSize():
@@ -647,32 +1001,42 @@ class _Bios:
         return (len(coreBuf) + Grub.DISK_SECTOR_SIZE - 1) // Grub.DISK_SECTOR_SIZE * Grub.DISK_SECTOR_SIZE * 2
 
     @classmethod
-    def _checkDisk(cls, dev, exceptionClass):
-        if not PartiUtil.isDiskOrParti(dev):
+    def _checkDisk(cls, dev, offset, diskInfoCache, exceptionClass):
+        # dev is a disk device, or a disk image file in which the disk image is at offset
+        if not os.path.isfile(dev) and not PartiUtil.isDiskOrParti(dev):
             if exceptionClass is not None:
                 raise exceptionClass("'%s' must be a disk" % (dev))
             else:
                 assert False
 
-        pDev = parted.getDevice(dev)
-        pDisk = parted.newDisk(pDev)
-        if pDisk.type != "msdos":
+        diskInfo = diskInfoCache.get(dev, offset)
+        if diskInfo.label_type != "msdos":
             if exceptionClass is not None:
                 raise exceptionClass("'%s' must have a MBR partition table" % (dev))
             else:
                 assert False
-        pPartiList = pDisk.getPrimaryPartitions()
-        if len(pPartiList) == 0:
+        if diskInfo.first_primary_partition_start is None:
             if exceptionClass is not None:
                 raise exceptionClass("'%s' have no partition" % (dev))
             else:
                 assert False
-        if pPartiList[0].geometry.start * pDev.sectorSize < cls._getCoreBufMaxSize():
+        if diskInfo.first_primary_partition_start * diskInfo.sector_size < cls._getCoreBufMaxSize():
             if exceptionClass is not None:
                 raise exceptionClass("'%s' has no MBR gap or its MBR gap is too small" % (dev))
             else:
                 assert False
 
+    @classmethod
+    def _readMbrAndMbrGap(cls, dev, offset, bDirectIo, exceptionClass):
+        with trace_span("read_mbr"):
+            snapshot = SectorSnapshot(dev, offset, cls._getCoreBufMaxSize(), bDirectIo)
+        if len(snapshot) < cls._getCoreBufMaxSize():
+            if exceptionClass is not None:
+                raise exceptionClass("'%s' is smaller than the MBR gap" % (dev))
+            else:
+                assert False
+        return snapshot
+
     @staticmethod
     def _checkAndReadBootImg(platform_type, bootDir, exceptionClass):
         bootImgFile = os.path.join(bootDir, "grub", platform_type.value, "boot.img")
@@ -714,14 +1078,16 @@ class _Bios:
         if noRsLen == 0xFFFF:
             raise InstallError("core.img version mismatch")
 
-        newLen = cls._getCoreBufPossibleSize(coreBuf)
+        # the field holds the number of redundancy bytes, same as grub-install
+        redundancy = cls._getCoreBufPossibleSize(coreBuf) - len(coreBuf)
         coreBuf = bytearray(coreBuf)
         struct.pack_into(">I" if bigOrLittleEndian else "<I",
-                         coreBuf, Grub.DISK_SECTOR_SIZE + Grub.KERNEL_I386_PC_REED_SOLOMON_REDUNDANCY, newLen)
+                         coreBuf, Grub.DISK_SECTOR_SIZE + Grub.KERNEL_I386_PC_REED_SOLOMON_REDUNDANCY, redundancy)
 
+        # encoded result is cached by content digest, so repeated open and verification does no encoding work
         noRsLen += Grub.DISK_SECTOR_SIZE
-        rsc = reedsolo.RSCodec(newLen - len(coreBuf))
-        return bytes(coreBuf[:noRsLen]) + rsc.encode(coreBuf[noRsLen:])
+        with trace_span("rs_encode"):
+            return bytes(coreBuf[:noRsLen]) + rs_encode(bytes(coreBuf[noRsLen:]), redundancy)
 
 
 class _Efi:
@@ -795,53 +1161,447 @@ class _Efi:
         force_rm(os.path.join(bootDir, "EFI"))
 
 
+class _DiskInfo:
+
+    """Partition table facts of a disk, read by parted"""
+
+    def __init__(self, dev):
+        self.device = dev
+        self.parted_device = parted.getDevice(dev)
+        self.parted_disk = parted.newDisk(self.parted_device)
+        self.label_type = self.parted_disk.type
+        self.sector_size = self.parted_device.sectorSize
+
+        pPartiList = self.parted_disk.getPrimaryPartitions()
+        if len(pPartiList) > 0:
+            self.first_primary_partition_start = pPartiList[0].geometry.start
+        else:
+            self.first_primary_partition_start = None
+
+
+class _DiskImageInfo:
+
+    """Same as _DiskInfo, for disk image file, MBR partition table is parsed directly so that no loop device is needed"""
+
+    def __init__(self, path, offset):
+        self.device = path
+        self.offset = offset
+        self.sector_size = Grub.DISK_SECTOR_SIZE
+        self.first_primary_partition_start = None
+
+        buf = SectorSnapshot(path, offset, Grub.DISK_SECTOR_SIZE).view
+        if len(buf) < Grub.DISK_SECTOR_SIZE or buf[Grub.BOOT_MACHINE_PART_END:Grub.DISK_SECTOR_SIZE] != b'\x55\xAA':
+            self.label_type = None
+            return
+
+        entryList = []
+        for i in range(Grub.BOOT_MACHINE_PART_START, Grub.BOOT_MACHINE_PART_END, 16):
+            pType, start = struct.unpack_from("<4xB3xI", buf, i)
+            entryList.append((pType, start))
+
+        if any([x[0] == 0xEE for x in entryList]):
+            self.label_type = "gpt"                                 # protective MBR
+        else:
+            self.label_type = "msdos"
+            # entries are not sorted by start, and an extended partition (0x05, 0x0F, 0x85) also ends the MBR gap since its EBR is at its start
+            startList = [start for pType, start in entryList if pType != 0]
+            if len(startList) > 0:
+                self.first_primary_partition_start = min(startList)
+
+
+class _DiskInfoCache:
+
+    """Per-Target cache of _DiskInfo, it is invalidated when we write to the disk or Target.invalidate_cache() is called"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dict = dict()
+
+    def get(self, dev, offset=0):
+        with self._lock:
+            ret = self._dict.get((dev, offset))
+            if ret is None:
+                if os.path.isfile(dev):
+                    with trace_span("read_partition_table", device=dev):
+                        ret = _DiskImageInfo(dev, offset)
+                else:
+                    assert offset == 0
+                    with trace_span("parted", device=dev):
+                        ret = _DiskInfo(dev)
+                self._dict[(dev, offset)] = ret
+            return ret
+
+    def invalidate(self):
+        with self._lock:
+            self._dict.clear()
+
+
 class _PyCdLib:
 
+    """Same as _Common, _Bios and _Efi for ISO_DIR, but files are added into pycdlib object without being staged"""
+
     @staticmethod
     def init_platforms(p):
-        pass
+        grubDir = os.path.join(p._bootDir, "grub")
+        if p._isoFs.isdir(grubDir):
+            for fn in p._isoFs.listdir(grubDir):
+                try:
+                    obj = PlatformInstallInfo()
+                    obj.status = PlatformInstallInfo.Status.NORMAL
+                    p._platforms[PlatformType(fn)] = obj
+                except ValueError:
+                    pass
 
+    @staticmethod
+    def fill_platform_install_info_bios(p, platform_type, platform_install_info):
+        platDir = os.path.join(p._bootDir, "grub", platform_type.value)
+        for fn in ["boot.img", Grub.getCoreImgNameAndTarget(platform_type)[0]]:
+            if not p._isoFs.exists(os.path.join(platDir, fn)):
+                raise TargetError("'%s' does not exist" % (os.path.join(platDir, fn)))
 
-def _newNotValidPlatformInstallInfo(reason):
-    ret = PlatformInstallInfo()
-    ret.status = PlatformInstallInfo.Status.NOT_VALID
-    ret.reason = reason
-    return ret
+        platform_install_info.mbr_installed = False
+        platform_install_info.allow_floppy = True
+        platform_install_info.bpb = True
+        platform_install_info.rs_codes = True
+        platform_install_info.eltorito = p._isoFs.exists(os.path.join(platDir, Grub.ELTORITO_IMG_NAME))
 
+    @staticmethod
+    def fill_platform_install_info_efi(p, platform_type, platform_install_info):
+        coreFullfn = os.path.join(p._bootDir, "grub", platform_type.value, Grub.getCoreImgNameAndTarget(platform_type)[0])
+        efiFullfn = os.path.join("/EFI", "BOOT", Handy.getStandardEfiFilename(platform_type))
 
-def _newNotInstalledPlatformInstallInfo():
-    ret = PlatformInstallInfo()
-    ret.status = PlatformInstallInfo.Status.NOT_INSTALLED
-    return ret
+        if not p._isoFs.exists(coreFullfn):
+            raise TargetError("%s does not exist" % (coreFullfn))
+        if not p._isoFs.exists(efiFullfn):
+            raise TargetError("%s does not exist" % (efiFullfn))
+        if p._isoFs.read(coreFullfn) != p._isoFs.read(efiFullfn):
+            raise TargetError("%s and %s are different" % (coreFullfn, efiFullfn))
 
+        platform_install_info.esp_is_rootfs = True
+        platform_install_info.removable = True
+        platform_install_info.nvram = False
 
-#     @staticmethod
-#     def install_platform_for_iso(platform_type, source, bootDir, dev, bHddOrFloppy, bInstallMbr):
+    @staticmethod
+    def install_platform(p, platform_type, source, tmpDir=None, debugImage=None, modules="*", bEltorito=False):
+        platDirDst = os.path.join(p._bootDir, "grub", platform_type.value)
+        fileList = _Common.get_platform_files_to_install(p, platform_type, source, modules)
+        modListContent = _Common.get_module_list_file_content(modules)
 
-#         if
+        # El Torito boot catalog references eltorito.img, which may be removed below
+        if platform_type == PlatformType.I386_PC:
+            _PyCdLib._removeEltorito(p)
 
+        # add module files, they are referenced by pycdlib object and read when the ISO is written
+        with trace_span("add_modules"):
+            p._isoFs.makedirs(platDirDst)
+            p._isoFs.remove_redundant_entries(platDirDst, set([os.path.basename(x) for x in fileList]))
+            for x in fileList:
+                p._isoFs.add_file(os.path.join(platDirDst, os.path.basename(x)), x)
 
+        # record the install mode
+        if modListContent is not None:
+            p._isoFs.add_buf(os.path.join(platDirDst, Grub.MODULE_LIST_FILE_NAME), modListContent.encode())
 
-#         char *output = grub_util_path_concat (3, boot_grub, "i386-pc", "eltorito.img");
-#       load_cfg = grub_util_make_temporary_file ();
+        # make core.img
+        coreName = Grub.getCoreImgNameAndTarget(platform_type)[0]
+        coreBuf = Grub.makeCoreImage(source, platform_type, *_Common.get_core_image_args(p, platform_type), debugImage, tmpDir=tmpDir, cache=p._coreImageCache)
+        p._isoFs.add_buf(os.path.join(platDirDst, coreName), coreBuf)
 
+        # make eltorito.img
+        if bEltorito:
+            p._isoFs.add_buf(os.path.join(platDirDst, Grub.ELTORITO_IMG_NAME), _Common.make_eltorito_image(p, source, debugImage, tmpDir=tmpDir))
 
+    @staticmethod
+    def install_bios(p, platform_type, platform_install_info, source, bEltorito, bHybridMbr):
+        platDirSrc = source.get_platform_directory(platform_type)
+        platDirDst = os.path.join(p._bootDir, "grub", platform_type.value)
 
-#       grub_install_push_module ("biosdisk");
-#       grub_install_push_module ("iso9660");
-#       grub_install_make_image_wrap (source_dirs[GRUB_INSTALL_PLATFORM_I386_PC],
-#             "/boot/grub", output,
-#             0, load_cfg,
-#             "i386-pc-eltorito", 0);
-#       xorriso_push ("-boot-load-size");
-#       xorriso_push ("4");
-#       xorriso_push ("-boot-info-table");
+        # add boot.img
+        p._isoFs.add_file(os.path.join(platDirDst, "boot.img"), os.path.join(platDirSrc, "boot.img"))
+
+        # add El Torito boot record, the boot info table is filled by pycdlib when the ISO is written, same as grub-mkrescue
+        if bEltorito:
+            p._isoFs.add_eltorito(os.path.join(platDirDst, Grub.ELTORITO_IMG_NAME),
+                                  boot_load_size=Grub.ELTORITO_BOOT_LOAD_SIZE, boot_info_table=True)
+
+        # hybrid MBR is written by Target.write_iso()
+        if bEltorito and bHybridMbr:
+            if "boot_hybrid.img" not in source.get_platform_files(platform_type):
+                raise InstallError("%s does not exist" % (os.path.join(platDirSrc, "boot_hybrid.img")))
+            p._isoHybridMbr = pathlib.Path(os.path.join(platDirSrc, "boot_hybrid.img")).read_bytes()
+            if len(p._isoHybridMbr) != Grub.DISK_SECTOR_SIZE:
+                raise InstallError("the size of '%s' is not %u" % (os.path.join(platDirSrc, "boot_hybrid.img"), Grub.DISK_SECTOR_SIZE))
+        else:
+            p._isoHybridMbr = None
+
+        # fill custom attributes
+        platform_install_info.mbr_installed = False
+        platform_install_info.allow_floppy = True
+        platform_install_info.bpb = True
+        platform_install_info.rs_codes = False
+        platform_install_info.eltorito = bEltorito
+
+    @staticmethod
+    def install_efi(p, platform_type, platform_install_info, bRemovable):
+        assert bRemovable                               # FIXME
+
+        # add efi file
+        coreName = Grub.getCoreImgNameAndTarget(platform_type)[0]
+        p._isoFs.makedirs(os.path.join("/EFI", "BOOT"))
+        p._isoFs.add_buf(os.path.join("/EFI", "BOOT", Handy.getStandardEfiFilename(platform_type)),
+                         p._isoFs.read(os.path.join(p._bootDir, "grub", platform_type.value, coreName)))
+
+        # fill custom attributes
+        platform_install_info.esp_is_rootfs = True
+        platform_install_info.removable = bRemovable
+        platform_install_info.nvram = False
+
+    @staticmethod
+    def install_data_files(p, source, locales, fonts, themes):
+        grubDir = os.path.join(p._bootDir, "grub")
+        p._isoFs.makedirs(grubDir)
+
+        # other files in the directories are removed
+        if locales is not None:
+            if locales == "*":
+                fileDict = {"%s.mo" % (lname): fullfn for lname, fullfn in source.get_all_locale_files().items()}
+            else:
+                fileDict = {"%s.mo" % (lname): source.get_locale_file(lname) for lname in locales}
+            _PyCdLib._addFiles(p, os.path.join(grubDir, "locale"), fileDict)
+
+        if fonts is not None:
+            if fonts == "*":
+                fileDict = {"%s.pf2" % (fname): fullfn for fname, fullfn in source.get_all_font_files().items()}
+            else:
+                fileDict = {"%s.pf2" % (fname): source.get_font_file(fname) for fname in fonts}
+            _PyCdLib._addFiles(p, os.path.join(grubDir, "fonts"), fileDict)
+
+        if themes is not None:
+            dstDir = os.path.join(grubDir, "themes")
+            p._isoFs.makedirs(dstDir)
+            if themes == "*":
+                themeDict = source.get_all_theme_directories()
+            else:
+                themeDict = {tname: source.get_theme_directory(tname) for tname in themes}
+            p._isoFs.remove_redundant_entries(dstDir, set(themeDict.keys()))
+            for tname, fullfn in themeDict.items():
+                p._isoFs.remove(os.path.join(dstDir, tname))
+                _PyCdLib._addTree(p, fullfn, os.path.join(dstDir, tname))
+
+    @staticmethod
+    def remove_data_files(p):
+        grubDir = os.path.join(p._bootDir, "grub")
+        p._isoFs.remove(os.path.join(grubDir, "locale"))
+        p._isoFs.remove(os.path.join(grubDir, "fonts"))
+        p._isoFs.remove(os.path.join(grubDir, "themes"))
+
+    @staticmethod
+    def remove_platform(p, platform_type):
+        if platform_type == PlatformType.I386_PC:
+            _PyCdLib._removeEltorito(p)
+        if Handy.isPlatformEfi(platform_type):
+            efiDirLv2 = os.path.join("/EFI", "BOOT")
+            p._isoFs.remove(os.path.join(efiDirLv2, Handy.getStandardEfiFilename(platform_type)))
+            p._isoFs.rmdir_if_empty(efiDirLv2)
+            p._isoFs.rmdir_if_empty("/EFI")
+        p._isoFs.remove(os.path.join(p._bootDir, "grub", platform_type.value))
+
+    @staticmethod
+    def remove_remaining_crufts(p):
+        _PyCdLib._removeEltorito(p)
+        p._isoFs.remove("/EFI")
+        p._isoFs.remove(os.path.join(p._bootDir, "EFI"))
+        p._isoFs.remove(os.path.join(p._bootDir, "grub"))
+
+    @staticmethod
+    def check_platform(p, platform_type, source, tmpDir=None):
+        # returns names of the files that are not checked
+        platDirSrc = source.get_platform_directory(platform_type)
+        platDirDst = os.path.join(p._bootDir, "grub", platform_type.value)
+        assert p._isoFs.isdir(platDirDst)
+
+        dstNameList = p._isoFs.listdir(platDirDst)
+        nameSet = set()
+
+        def __check(fn):
+            fullfn, fullfn2 = os.path.join(platDirSrc, fn), os.path.join(platDirDst, fn)
+            if fn not in dstNameList:
+                raise CompareWithSourceError("%s does not exist" % (fullfn2))
+            if not compare_file_and_content(fullfn, p._isoFs.read(fullfn2)):
+                raise CompareWithSourceError("%s and %s are different" % (fullfn, fullfn2))
+            nameSet.add(fn)
+
+        # check module files
+        if Grub.MODULE_LIST_FILE_NAME in dstNameList:
+            userModuleList = p._isoFs.read(os.path.join(platDirDst, Grub.MODULE_LIST_FILE_NAME)).decode().split()
+            nameSet.add(Grub.MODULE_LIST_FILE_NAME)
+        else:
+            userModuleList = None
+        modNameSet = _Common.get_module_names_to_check(p, platform_type, source, [x for x in dstNameList if x.endswith(".mod")], userModuleList)
+        for name in sorted(modNameSet):
+            __check(name + ".mod")
+
+        # check addon files
+        for fn in Grub.PLATFORM_ADDON_FILES:
+            __check(fn)
+
+        # check optional addon files
+        for fn in Grub.PLATFORM_OPTIONAL_ADDON_FILES:
+            if os.path.exists(os.path.join(platDirSrc, fn)):
+                __check(fn)
+
+        # check core.img
+        coreName = Grub.getCoreImgNameAndTarget(platform_type)[0]
+        coreBuf2 = p._isoFs.read(os.path.join(platDirDst, coreName)) if coreName in dstNameList else None
+        for debugImage in [None, False, True]:
+            coreBuf = Grub.makeCoreImage(source, platform_type, *_Common.get_core_image_args(p, platform_type), debugImage, tmpDir=tmpDir, cache=p._coreImageCache)
+            if coreBuf == coreBuf2:
+                nameSet.add(coreName)
+                break
+        else:
+            raise CompareWithSourceError("%s is different with the generated core image" % (os.path.join(platDirDst, coreName)))
+
+        # check redundant
+        return set(dstNameList) - nameSet
+
+    @staticmethod
+    def check_rest_files_bios(p, platform_type, source, rest_files):
+        platDirDst = os.path.join(p._bootDir, "grub", platform_type.value)
+        srcFile = os.path.join(source.get_platform_directory(platform_type), "boot.img")
+        dstFile = os.path.join(platDirDst, "boot.img")
+        if "boot.img" not in rest_files:
+            raise CompareWithSourceError("%s does not exist" % (dstFile))
+        rest_files.remove("boot.img")
+        if not compare_file_and_content(srcFile, p._isoFs.read(dstFile)):
+            raise CompareWithSourceError("%s and %s are different" % (srcFile, dstFile))
+
+        _Common.check_eltorito_image(p, source, rest_files, tmpDir=p._tmpDir, readFunc=p._isoFs.read)
+
+        if len(rest_files) > 0:
+            raise CompareWithSourceError("redundant file %s found" % (os.path.join(platDirDst, sorted(rest_files)[0])))
+
+    @staticmethod
+    def prepare_check_data(p, source):
+        # returns a list of check functions, so that they can be run in parallel
+        ret = []
+
+        def __check(fullfn, fullfn2):
+            if not compare_file_and_content(fullfn, p._isoFs.read(fullfn2)):
+                raise CompareWithSourceError("%s and %s are different" % (fullfn, fullfn2))
+
+        def __fail(msg):
+            raise CompareWithSourceError(msg)
+
+        def __checkDir(fullfn, fullfn2):
+            nameList = sorted(os.listdir(fullfn))
+            if nameList != sorted(p._isoFs.listdir(fullfn2)):
+                raise CompareWithSourceError("%s and %s are different" % (fullfn, fullfn2))
+            for fn in nameList:
+                if os.path.isdir(os.path.join(fullfn, fn)):
+                    __checkDir(os.path.join(fullfn, fn), os.path.join(fullfn2, fn))
+                else:
+                    __check(os.path.join(fullfn, fn), os.path.join(fullfn2, fn))
+
+        for dirName, ext, cap, getFunc, checkFunc in [
+            ("locale", ".mo", source.CAP_NLS, source.try_get_locale_file, __check),
+            ("fonts", ".pf2", source.CAP_FONTS, source.try_get_font_file, __check),
+            ("themes", "", source.CAP_THEMES, source.try_get_theme_directory, __checkDir),
+        ]:
+            dstDir = os.path.join(p._bootDir, "grub", dirName)
+            if not p._isoFs.exists(dstDir):
+                continue
+            if not source.supports(cap):
+                ret.append(functools.partial(__fail, "%s is not supported" % (dirName)))
+                continue
+            for fn2 in sorted(p._isoFs.listdir(dstDir)):
+                fullfn2 = os.path.join(dstDir, fn2)
+                if fn2.endswith(ext) and p._isoFs.isdir(fullfn2) == (ext == ""):
+                    fullfn = getFunc(fn2[:len(fn2) - len(ext)])
+                    if fullfn is not None:
+                        ret.append(functools.partial(checkFunc, fullfn, fullfn2))
+                        continue
+                ret.append(functools.partial(__fail, "redundant file %s found" % (fullfn2)))
+
+        return ret
+
+    @staticmethod
+    def get_hybrid_patches(p, isoSize):
+        # returns [(offset, buf)] for the written ISO, the same as the "--grub2-mbr", "--grub2-boot-info" and "--protective-msdos-label" of xorriso
+        if p._isoHybridMbr is None:
+            return []
+
+        eltoritoPath = os.path.join(p._bootDir, "grub", PlatformType.I386_PC.value, Grub.ELTORITO_IMG_NAME)
+        eltoritoOffset = p._isoFs.get_extent_offset(eltoritoPath)
+        eltoritoSector = eltoritoOffset // Grub.DISK_SECTOR_SIZE
+
+        # MBR loads diskboot.img, which is the 5th sector of eltorito.img, the first 4 sectors are cdboot.img
+        mbrBuf = bytearray(Grub.DISK_SECTOR_SIZE)
+        mbrBuf[:Grub.BOOT_MACHINE_WINDOWS_NT_MAGIC] = p._isoHybridMbr[:Grub.BOOT_MACHINE_WINDOWS_NT_MAGIC]
+        struct.pack_into("<Q", mbrBuf, Grub.BOOT_MACHINE_HYBRID_KERNEL_SECTOR, eltoritoSector + 4)
+        mbrBuf[Grub.BOOT_MACHINE_PART_START:Grub.BOOT_MACHINE_PART_START + 16] = _PyCdLib._getPartitionEntry(1, isoSize // Grub.DISK_SECTOR_SIZE - 1)
+        mbrBuf[Grub.BOOT_MACHINE_PART_END:] = b'\x55\xAA'
+
+        # diskboot.img loads the rest of core.img, the first entry of its blocklist is patched, the boot info table checksum is updated accordingly
+        bootInfoBuf = struct.pack("<Q", eltoritoSector + 5)
+        eltoritoBuf = bytearray(p._isoFs.read(eltoritoPath))
+        eltoritoBuf[Grub.ELTORITO_GRUB2_BOOT_INFO:Grub.ELTORITO_GRUB2_BOOT_INFO + len(bootInfoBuf)] = bootInfoBuf
+        eltoritoBuf += bytes(-len(eltoritoBuf) % 4)
+        checksum = sum(struct.unpack_from("<%uI" % ((len(eltoritoBuf) - 64) // 4), eltoritoBuf, 64)) & 0xFFFFFFFF
+
+        return [
+            (0, bytes(mbrBuf)),
+            (eltoritoOffset + Grub.ELTORITO_GRUB2_BOOT_INFO, bootInfoBuf),
+            (eltoritoOffset + 20, struct.pack("<I", checksum)),                                 # bi_Checksum field of the boot info table
+        ]
+
+    @staticmethod
+    def _getPartitionEntry(start, count):
+        # active partition with type 0xCD, which claims the ISO image except the first sector
+        def __chs(lba):
+            c, h, s = lba // (255 * 63), lba // 63 % 255, lba % 63 + 1
+            if c > 1023:
+                return b'\xFE\xFF\xFF'
+            return bytes([h, ((c >> 2) & 0xC0) | s, c & 0xFF])
+        return b'\x80' + __chs(start) + b'\xCD' + __chs(start + count - 1) + struct.pack("<II", start, count)
+
+    @staticmethod
+    def _removeEltorito(p):
+        # El Torito boot catalog is created by us, and it contains only the entry of eltorito.img
+        p._isoFs.rm_eltorito()
+        p._isoHybridMbr = None
+
+    @staticmethod
+    def _addFiles(p, dstDir, fileDict):
+        p._isoFs.makedirs(dstDir)
+        p._isoFs.remove_redundant_entries(dstDir, set(fileDict.keys()))
+        for fn, fullfn in fileDict.items():
+            p._isoFs.add_file(os.path.join(dstDir, fn), fullfn)
+
+    @staticmethod
+    def _addTree(p, srcDir, dstDir):
+        p._isoFs.makedirs(dstDir)
+        for de in os.scandir(srcDir):
+            if de.is_dir():
+                _PyCdLib._addTree(p, de.path, os.path.join(dstDir, de.name))
+            else:
+                p._isoFs.add_file(os.path.join(dstDir, de.name), de.path)
+
+
+_defaultCoreImageCache = CoreImageCache()
+
+
+def _newNotValidPlatformInstallInfo(reason):
+    ret = PlatformInstallInfo()
+    ret.status = PlatformInstallInfo.Status.NOT_VALID
+    ret.reason = reason
+    return ret
+
+
+def _newNotInstalledPlatformInstallInfo():
+    ret = PlatformInstallInfo()
+    ret.status = PlatformInstallInfo.Status.NOT_INSTALLED
+    return ret
 
-# 	      char *boot_hybrid = grub_util_path_concat (2, source_dirs[GRUB_INSTALL_PLATFORM_I386_PC],
-#             	 "boot_hybrid.img");
-# 	      xorriso_push ("--grub2-boot-info");
-# 	      xorriso_push ("--grub2-mbr");
-# 	      xorriso_push (boot_hybrid);
 
 #   /** build multiboot core.img */
 #   grub_install_push_module ("pata");
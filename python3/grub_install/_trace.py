@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import abc
+import time
+import threading
+import contextvars
+
+
+class Tracer(abc.ABC):
+
+    """Interface of a tracing callback, span_finished() is called when a span ends, from the thread that runs it"""
+
+    @abc.abstractmethod
+    def span_finished(self, span):
+        pass
+
+
+class Span:
+
+    """A named phase, counters of child spans are added to their parent when they finish"""
+
+    def __init__(self, tracer, name, parent, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.path = name if parent is None else parent.path + "/" + name
+        self.attrs = attrs
+        self.counters = dict()                  # e.g. "subprocesses", "bytes_read", "bytes_written", "bytes_copied"
+        self.start_time = None                  # time.monotonic() when the span starts
+        self.duration = None                    # seconds
+        self._lock = threading.Lock()
+        self._token = None
+
+    def add(self, key, n=1):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def __enter__(self):
+        self._token = _currentSpan.set(self)
+        self.start_time = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.monotonic() - self.start_time
+        _currentSpan.reset(self._token)
+        if exc_type is not None:
+            self.attrs["error"] = repr(exc_value)
+        if self.parent is not None:
+            for k, v in self.counters.items():
+                self.parent.add(k, v)
+        self.tracer.span_finished(self)
+
+    def __repr__(self):
+        return "<%s %s %r %r>" % (self.__class__.__name__, self.path, self.attrs, self.counters)
+
+
+class _NullSpan:
+
+    def add(self, key, n=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def trace_span(name, tracer=None, **attrs):
+    # returns a child span of the current span, or a root span if tracer is specified, or a shared no-op span
+    parent = _currentSpan.get()
+    if parent is not None:
+        return Span(parent.tracer, name, parent, attrs)
+    if tracer is not None:
+        return Span(tracer, name, None, attrs)
+    return _nullSpan
+
+
+def trace_count(key, n=1):
+    span = _currentSpan.get()
+    if span is not None:
+        span.add(key, n)
+
+
+_currentSpan = contextvars.ContextVar("grub_install_current_span", default=None)
+
+_nullSpan = _NullSpan()
@@ -21,11 +21,21 @@
 # THE SOFTWARE.
 
 
+import io
 import os
 import re
+import mmap
+import stat
+import fcntl
 import shutil
+import struct
 import pathlib
-import filecmp
+import threading
+import itertools
+import contextvars
+import concurrent.futures
+from ._cache import get_default_digest_cache
+from ._trace import trace_count
 
 
 def rel_path(baseDir, path):
@@ -72,6 +82,12 @@ def rmdir_if_empty(path):
             os.rmdir(path)
 
 
+def remove_redundant_entries(dirpath, keep_name_set):
+    for fn in os.listdir(dirpath):
+        if fn not in keep_name_set:
+            force_rm(os.path.join(dirpath, fn))
+
+
 def compare_file_and_content(filepath, content):
     if isinstance(content, str):
         return pathlib.Path(filepath).read_text() == content
@@ -84,25 +100,417 @@ def compare_file_and_content(filepath, content):
 def compare_files(filepath1, filepath2):
     # don't use filecmp.cmp() directly
     # filecmp.dircmp is too complex, we created function compare_files() and compare_directories()
-    return filecmp.cmp(filepath1, filepath2, shallow=False)
+    # file content is compared by digest, digests are cached so that each file is read only once
+    st1, st2 = os.stat(filepath1), os.stat(filepath2)
+    if st1.st_size != st2.st_size:
+        return False
+    if (st1.st_dev, st1.st_ino) == (st2.st_dev, st2.st_ino):
+        return True
+    digestCache = get_default_digest_cache()
+    return digestCache.get_digest(filepath1, st1) == digestCache.get_digest(filepath2, st2)
 
 
 def compare_directories(dirpath1, dirpath2):
-    ret1 = set(os.listdir(dirpath1))
-    ret2 = set(os.listdir(dirpath2))
-    if ret1 != ret2:
-        return False
-    for fn in ret1:
-        if not filecmp.cmp(os.path.join(dirpath1, fn), os.path.join(dirpath2, fn), shallow=False):
-            return False
-    return True
+    return len(diff_directories(dirpath1, dirpath2)) == 0
+
+
+def diff_directories(dirpath1, dirpath2, full_report=False, max_workers=None):
+    # compare two directory trees recursively, returns the relative paths that are different
+    # names, types and sizes are compared first without reading any content, then content of regular files is compared in parallel
+    # stops at the first difference unless full_report is True
+    ret = []
+
+    def __walk(dirpath, relDir, result):
+        for de in os.scandir(os.path.join(dirpath, relDir)):
+            rp = os.path.join(relDir, de.name)
+            if de.is_symlink():
+                result[rp] = ("l", os.readlink(de.path))
+            elif de.is_dir():
+                result[rp] = ("d", None)
+                __walk(dirpath, rp, result)
+            elif de.is_file():
+                result[rp] = ("f", de.stat().st_size)
+            else:
+                result[rp] = ("o", None)
+        return result
+
+    info1 = __walk(dirpath1, "", dict())
+    info2 = __walk(dirpath2, "", dict())
+
+    # compare names, types and sizes
+    fileList = []
+    for rp in sorted(info1.keys() | info2.keys()):
+        if info1.get(rp) != info2.get(rp):
+            ret.append(rp)
+            if not full_report:
+                return ret
+        elif info1[rp][0] == "f":
+            fileList.append(rp)
+
+    # compare content
+    resultList = run_in_parallel([lambda rp=rp: compare_files(os.path.join(dirpath1, rp), os.path.join(dirpath2, rp)) for rp in fileList], max_workers)
+    for rp, bSame in zip(fileList, resultList):
+        if not bSame:
+            ret.append(rp)
+            if not full_report:
+                break
+
+    return sorted(ret)
+
+
+_zeroChunk = bytes(64 * 1024)
 
 
 def is_buffer_all_zero(buf):
-    for b in buf:
-        if b != 0:
-            return False
-    return True
+    return find_first_non_zero_byte(buf) < 0
+
+
+def find_first_non_zero_byte(buf):
+    # compare chunk by chunk with a zero block (memcmp speed), the first differing chunk is narrowed
+    # down by sectors and only the first differing sector is scanned byte-wise
+    # returns -1 if buf is all zero
+    view = memoryview(buf).cast("B")
+    for i in range(0, len(view), len(_zeroChunk)):
+        chunk = view[i:i + len(_zeroChunk)].tobytes()
+        if chunk != _zeroChunk[:len(chunk)]:
+            for j in range(0, len(chunk), 512):
+                sector = chunk[j:j + 512]
+                if sector != _zeroChunk[:len(sector)]:
+                    return i + j + len(sector) - len(sector.lstrip(b'\x00'))
+            assert False
+    return -1
+
+
+class SectorSnapshot:
+
+    """Content of a range of sectors, read with one aligned pread() into private memory, so it's not changed after the sectors are written
+    slices of self.view share memory with the snapshot, self.view is shorter than size if the device or file ends before offset + size"""
+
+    def __init__(self, path, offset, size, direct_io=False):
+        # buffered I/O is used if offset and size are not aligned to the logical block size of the device when direct_io is True
+        self.path = path
+        self.offset = offset
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if direct_io:
+                _tryEnableDirectIo(fd, offset, size)
+            buf = mmap.mmap(-1, size)                           # anonymous mmap is page aligned, which is required by O_DIRECT
+            n = os.preadv(fd, [buf], offset)
+            if n < size:
+                buf = buf[:n]                                   # short read at the end of the device
+        finally:
+            os.close(fd)
+        trace_count("bytes_read", len(buf))
+
+        # the mmap object is freed when the last memoryview slice is released
+        self.view = memoryview(buf).toreadonly()
+
+    def __len__(self):
+        return len(self.view)
+
+    def write_if_different(self, new_buf, sector_size, direct_io=False, sync=False):
+        # write the sectors of new_buf that differ from this snapshot, returns the number of bytes written
+        # ValueError is raised if the snapshot is short, sectors beyond the end of the device can't be written
+        return write_sectors_if_different(self.path, self.offset, new_buf, self.view, sector_size, direct_io, sync)
+
+
+def write_sectors_if_different(path, offset, new_buf, old_buf, sector_size, direct_io=False, sync=False):
+    # write the sectors of new_buf that differ from old_buf, adjacent dirty sectors are merged into one write
+    # dirty ranges are enlarged to the logical block size of the device for direct_io, buffered I/O is used if offset or size is not aligned to it
+    # returns the number of bytes written
+    if len(new_buf) != len(old_buf):
+        raise ValueError("%u bytes to write at offset %u of %s, but the old content has %u bytes" % (len(new_buf), offset, path, len(old_buf)))
+    assert len(new_buf) % sector_size == 0
+
+    newView, oldView = memoryview(new_buf), memoryview(old_buf)
+    runList = []
+    for i in range(0, len(new_buf), sector_size):
+        if newView[i:i + sector_size] != oldView[i:i + sector_size]:
+            if len(runList) > 0 and runList[-1][1] == i:
+                runList[-1][1] = i + sector_size
+            else:
+                runList.append([i, i + sector_size])
+    if len(runList) == 0:
+        return 0
+
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        if direct_io:
+            blockSize = _tryEnableDirectIo(fd, offset, len(new_buf))
+            direct_io = (blockSize is not None)
+        if direct_io:
+            if blockSize > sector_size:
+                alignedRunList = []
+                for s, e in runList:
+                    s, e = s // blockSize * blockSize, (e + blockSize - 1) // blockSize * blockSize
+                    if len(alignedRunList) > 0 and alignedRunList[-1][1] >= s:
+                        alignedRunList[-1][1] = e
+                    else:
+                        alignedRunList.append([s, e])
+                runList = alignedRunList
+            buf = mmap.mmap(-1, len(new_buf))
+            buf[:] = new_buf
+            newView = memoryview(buf)
+        try:
+            ret = 0
+            for s, e in runList:
+                while s < e:
+                    n = os.pwritev(fd, [newView[s:e]], offset + s)
+                    s += n
+                    ret += n
+        finally:
+            if direct_io:
+                newView.release()
+                buf.close()
+        if direct_io or sync:
+            os.fsync(fd)
+        trace_count("bytes_written", ret)
+        return ret
+    finally:
+        os.close(fd)
+
+
+def _getLogicalBlockSize(fd):
+    # the alignment of offset and size required by O_DIRECT
+    st = os.fstat(fd)
+    if stat.S_ISBLK(st.st_mode):
+        return struct.unpack("i", fcntl.ioctl(fd, _BLKSSZGET, bytes(4)))[0]
+    else:
+        return st.st_blksize                            # block size of the filesystem, which is a multiple of the logical block size of its device
+
+
+def _tryEnableDirectIo(fd, offset, size):
+    # returns the logical block size, returns None if offset or size is not aligned to it, so that buffered I/O should be used
+    blockSize = _getLogicalBlockSize(fd)
+    if offset % blockSize != 0 or size % blockSize != 0:
+        return None
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_DIRECT)
+    return blockSize
+
+
+# _IO(0x12, 104)
+_BLKSSZGET = 0x1268
+
+
+class PyCdLibFs:
+
+    """Filesystem like operations on the Rock Ridge name space of a pycdlib object, all paths are absolute Rock Ridge paths
+    ISO9660 names are generated (8.3 names, so they are valid in all interchange levels), Joliet names are added if the object has Joliet
+    files are added as references to the source files or buffers, their content is read when the ISO is written"""
+
+    def __init__(self, iso):
+        self._iso = iso
+        self._bJoliet = iso.has_joliet()
+        self._lock = threading.RLock()
+        self._dirDict = dict()                          # Rock Ridge path of directory -> {name: (ISO9660 path, is-directory)}
+
+    def invalidate_cache(self):
+        with self._lock:
+            self._dirDict.clear()
+
+    def exists(self, path):
+        with self._lock:
+            return self._getEntry(path) is not None
+
+    def isdir(self, path):
+        with self._lock:
+            e = self._getEntry(path)
+            return e is not None and e[1]
+
+    def listdir(self, path):
+        with self._lock:
+            d = self._getDir(path)
+            if d is None:
+                raise FileNotFoundError(path)
+            return list(d.keys())
+
+    def makedirs(self, path):
+        with self._lock:
+            if path == "/":
+                return
+            parentPath, name = os.path.split(path)
+            self.makedirs(parentPath)
+            d = self._getDir(parentPath)
+            if name in d:
+                if d[name][1]:
+                    return
+                self._remove(path)
+            isoPath = os.path.join(self._getIsoPath(parentPath), self._newIsoName(d, name, True))
+            self._iso.add_directory(iso_path=isoPath, rr_name=name, joliet_path=(path if self._bJoliet else None))
+            d[name] = (isoPath, True)
+            self._dirDict[path] = dict()
+
+    def add_file(self, path, src_file):
+        # parent directory of path must exist
+        with self._lock:
+            isoPath = self._prepareAdd(path)
+            self._iso.add_file(src_file, iso_path=isoPath, rr_name=os.path.basename(path), joliet_path=(path if self._bJoliet else None))
+            self._getDir(os.path.dirname(path))[os.path.basename(path)] = (isoPath, False)
+
+    def add_buf(self, path, buf):
+        # parent directory of path must exist, pycdlib keeps the file object until the ISO is written
+        with self._lock:
+            isoPath = self._prepareAdd(path)
+            self._iso.add_fp(io.BytesIO(buf), len(buf), iso_path=isoPath, rr_name=os.path.basename(path), joliet_path=(path if self._bJoliet else None), file_mode=0o100644)
+            self._getDir(os.path.dirname(path))[os.path.basename(path)] = (isoPath, False)
+
+    def get_iso_path(self, path):
+        with self._lock:
+            e = self._getEntry(path)
+            if e is None:
+                raise FileNotFoundError(path)
+            return e[0]
+
+    def add_eltorito(self, path, **kwargs):
+        # kwargs are the same as pycdlib's add_eltorito(), the boot catalog file is added into the root directory
+        with self._lock:
+            self._iso.add_eltorito(self.get_iso_path(path), **kwargs)
+            self._dirDict.clear()
+
+    def rm_eltorito(self):
+        # remove El Torito boot catalog, do nothing if there's none
+        with self._lock:
+            if self._iso.eltorito_boot_catalog is not None:
+                self._iso.rm_eltorito()
+                self._dirDict.clear()
+
+    def get_extent_offset(self, path):
+        # returns the byte offset of the file content in the written ISO
+        with self._lock:
+            return self._iso.get_record(iso_path=self.get_iso_path(path)).extent_location() * self._iso.logical_block_size
+
+    def read(self, path):
+        with self._lock:
+            e = self._getEntry(path)
+            if e is None or e[1]:
+                raise FileNotFoundError(path)
+            fp = io.BytesIO()
+            self._iso.get_file_from_iso_fp(fp, iso_path=e[0])
+            return fp.getvalue()
+
+    def remove(self, path):
+        # remove a file or a directory tree, same as force_rm()
+        with self._lock:
+            if self._getEntry(path) is not None:
+                self._remove(path)
+
+    def rmdir_if_empty(self, path):
+        with self._lock:
+            d = self._getDir(path)
+            if d is not None and len(d) == 0:
+                self._remove(path)
+
+    def remove_redundant_entries(self, dirpath, keep_name_set):
+        with self._lock:
+            for name in self.listdir(dirpath):
+                if name not in keep_name_set:
+                    self._remove(os.path.join(dirpath, name))
+
+    def _prepareAdd(self, path):
+        # returns the ISO9660 path for the new file, the old file is removed
+        parentPath, name = os.path.split(path)
+        d = self._getDir(parentPath)
+        if d is None:
+            raise FileNotFoundError(parentPath)
+        if name in d:
+            self._remove(path)
+        return os.path.join(self._getIsoPath(parentPath), self._newIsoName(d, name, False))
+
+    def _remove(self, path):
+        parentPath, name = os.path.split(path)
+        isoPath, bDir = self._getDir(parentPath)[name]
+        if bDir:
+            for name2 in self.listdir(path):
+                self._remove(os.path.join(path, name2))
+            self._iso.rm_directory(iso_path=isoPath)
+            del self._dirDict[path]
+        else:
+            self._rmFile(path, isoPath)
+        del self._getDir(parentPath)[name]
+
+    def _rmFile(self, path, isoPath):
+        # pycdlib's rm_file() removes all the records sharing the same data, which are different files for us (empty files read from an ISO)
+        rec = self._iso.get_record(iso_path=isoPath)
+        if rec.inode is None or len([x for x in rec.inode.linked_records if x[0].vd is self._iso.pvd]) <= 1:
+            self._iso.rm_file(iso_path=isoPath)
+            return
+        self._iso.rm_hard_link(iso_path=isoPath)
+        if self._bJoliet and any([x[0].vd is not self._iso.pvd and x[0].file_identifier().decode("utf_16_be") == os.path.basename(path) for x in rec.inode.linked_records]):
+            self._iso.rm_hard_link(joliet_path=path)
+
+    def _getIsoPath(self, path):
+        return "/" if path == "/" else self._getEntry(path)[0]
+
+    def _getEntry(self, path):
+        if path == "/":
+            return ("/", True)
+        parentPath, name = os.path.split(path)
+        d = self._getDir(parentPath)
+        return d.get(name) if d is not None else None
+
+    def _getDir(self, path):
+        # returns None if the directory does not exist, directory content is read from pycdlib object when it is first needed
+        ret = self._dirDict.get(path)
+        if ret is None:
+            e = self._getEntry(path)
+            if e is None or not e[1]:
+                return None
+            ret = dict()
+            for rec in self._iso.list_children(iso_path=e[0]):
+                if rec.is_dot() or rec.is_dotdot():
+                    continue
+                isoName = rec.file_identifier().decode("utf-8")
+                if rec.rock_ridge is not None and rec.rock_ridge.name() != b"":
+                    name = rec.rock_ridge.name().decode("utf-8")
+                else:
+                    name = isoName.split(";")[0].rstrip(".").lower()
+                ret[name] = (os.path.join(e[0], isoName), rec.is_dir())
+            self._dirDict[path] = ret
+        return ret
+
+    @staticmethod
+    def _newIsoName(d, name, bDir):
+        usedSet = set([os.path.basename(x[0]).split(";")[0] for x in d.values()])
+        if bDir:
+            base, ext = name, ""
+        else:
+            base, ext = os.path.splitext(name)
+        base = re.sub("[^A-Z0-9_]", "_", base.upper())[:8]
+        ext = re.sub("[^A-Z0-9_]", "_", ext[1:].upper())[:3]
+        for i in itertools.count():
+            n = base if i == 0 else base[:8 - len(str(i))] + str(i)
+            if not bDir:
+                n += "." + ext
+            if n not in usedSet:
+                return n if bDir else n + ";1"
+
+
+def run_in_parallel(func_list, max_workers=None):
+    # run functions in a bounded thread pool and return their results in list order
+    # if some functions fail, the exception of the first failed one in list order is raised, so error reporting is deterministic
+    # nested calls run the functions one by one in the calling worker thread, so that the number of threads is bounded by the outermost call
+    if len(func_list) == 0:
+        return []
+    if _inParallelWorker.get():
+        return [f() for f in func_list]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # each function runs in a copy of the caller's context, so that it's work is counted in the current trace span
+        futureList = [executor.submit(contextvars.copy_context().run, _runInParallelWorker, f) for f in func_list]
+        try:
+            return [f.result() for f in futureList]
+        except BaseException:
+            for f in futureList:
+                f.cancel()
+            raise
+
+
+def _runInParallelWorker(func):
+    _inParallelWorker.set(True)
+    return func()
+
+
+_inParallelWorker = contextvars.ContextVar("grub_install_in_parallel_worker", default=False)
 
 
 class PartiUtil: